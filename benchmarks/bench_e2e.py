@@ -0,0 +1,192 @@
+# benchmarks/bench_e2e.py
+"""Сквозной офлайн-бенчмарк VoiceBot против локальной замены Bot API.
+
+Бот запускается целиком (long polling, скачивание, очередь, распознавание,
+ответ), но вместо api.telegram.org ходит в FakeBotApi. Синтетические
+голосовые, видеосообщения и документы поступают в заданной пропорции и с
+заданной частотой; задержка считается от появления обновления в getUpdates
+до итоговой правки статусного сообщения.
+
+По умолчанию вместо Whisper используется заглушка, которая «распознаёт»
+запись за duration * rtf секунд, — так бенчмарк работает без сети и GPU.
+С --model tiny (или путём к локальной модели) загружается настоящая модель.
+Настройки бота (TRANSCRIBE_WORKERS, SCHEDULER_POLICY и т. д.) берутся из окружения.
+
+Пример:
+    python benchmarks/bench_e2e.py --updates 300 --rate 20 --chats 50 \\
+        --mix voice=6 video_note=3 document=1 --rtf 0.05
+"""
+
+import argparse
+import io
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import wave
+from collections import namedtuple
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+
+import numpy as np
+from common import format_row, percentile, synthetic_update
+from fake_telegram import FakeBotApi
+
+import main as voicebot
+
+StubSegment = namedtuple('StubSegment', 'start end text')
+
+
+class StubModel:
+    """Заглушка WhisperModel: спит пропорционально длительности записи и возвращает один сегмент."""
+
+    def __init__(self, rtf):
+        self.rtf = rtf
+
+    def transcribe(self, audio, language=None, **options):
+        duration = len(audio) / voicebot.SAMPLE_RATE
+        time.sleep(duration * self.rtf)
+        segments = iter([StubSegment(0.0, duration, f'распознанный текст длиной {duration:.0f} секунд')])
+        return segments, SimpleNamespace(duration=duration, language=language or 'ru', language_probability=1.0)
+
+
+def synthetic_wav(seconds, seed=0):
+    """WAV 16 кГц моно с тихим шумом: декодируется PyAV так же, как настоящий файл."""
+    samples = np.random.default_rng(seed).normal(0, 300, int(seconds * voicebot.SAMPLE_RATE)).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(voicebot.SAMPLE_RATE)
+        output.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def parse_pairs(pairs, cast):
+    result = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        result[key] = cast(value)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=0, help='обновлений в секунду (0 — все сразу)')
+    parser.add_argument('--chats', type=int, default=50, help='число личных чатов-отправителей')
+    parser.add_argument('--mix', nargs='+', default=['voice=6', 'video_note=3', 'document=1'],
+                        help='доли типов обновлений, kind=weight')
+    parser.add_argument('--seconds', nargs='+', default=['voice=8', 'video_note=20', 'document=120'],
+                        help='длительность записей по типам, kind=seconds')
+    parser.add_argument('--sample', help='настоящий аудиофайл вместо синтетического шума для всех записей')
+    parser.add_argument('--model', default='stub', help='stub, имя модели Whisper или путь к ней')
+    parser.add_argument('--compute-type', default='int8')
+    parser.add_argument('--rtf', type=float, default=0.05, help='RTF заглушки')
+    parser.add_argument('--timeout', type=float, default=600, help='сколько ждать завершения, с')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    mix = parse_pairs(args.mix, float)
+    seconds = parse_pairs(args.seconds, float)
+    random.seed(args.seed)
+
+    # Бот создаёт рабочие каталоги и базы в текущем каталоге — уводим их во временный
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    os.chdir(workdir)
+    os.environ.update(TELEGRAM_BOT_TOKEN='1:bench', STREAM_MODE='False', DEBUG_MODE='False',
+                      JOURNAL_PATH=os.path.join(workdir, 'jobs.sqlite3'),
+                      CACHE_PATH=os.path.join(workdir, 'cache.sqlite3'))
+    os.environ.pop('WEBHOOK_URL', None)
+    os.environ.setdefault('METRICS_PORT', '0')
+    # Синтетические записи одного типа одинаковы: без этого почти все задачи закрывал бы индекс отпечатков
+    os.environ.setdefault('DEDUP_SECONDS', '0')
+
+    if args.model == 'stub':
+        # Пакетные пути BatchedInferencePipeline требуют настоящую модель
+        os.environ.update(LONG_MEDIA_SECONDS='0', MICRO_BATCH_SIZE='1')
+        voicebot.load_whisper_model = lambda *_, **__: StubModel(args.rtf)
+    else:
+        load = voicebot.load_whisper_model
+        voicebot.load_whisper_model = lambda device, **kwargs: load(
+            device, **dict(kwargs, model_size=args.model, compute_type=args.compute_type))
+
+    started = {}
+    finished = {}
+    failed = set()
+    lock = Lock()
+    done = Event()
+
+    def on_edit(chat_id, message_id, text):
+        origin = api.replies.get((chat_id, message_id))
+        if origin is None or text == 'Распознавание...' or text.startswith('Место в очереди'):
+            return
+        with lock:
+            if origin in finished:
+                return
+            finished[origin] = time.perf_counter()
+            if text.startswith('Ошибка'):
+                failed.add(origin)
+            if len(finished) == args.updates:
+                done.set()
+
+    api = FakeBotApi(on_edit=on_edit)
+    api.start()
+
+    kinds = list(mix)
+    plan = random.choices(kinds, weights=[mix[kind] for kind in kinds], k=args.updates)
+    sample = open(args.sample, 'rb').read() if args.sample else None
+    contents = {kind: sample or synthetic_wav(seconds.get(kind, 10), args.seed) for kind in kinds}
+    updates = []
+    for index, kind in enumerate(plan, start=1):
+        update = synthetic_update(index, 1000 + index % args.chats, kind, duration=int(seconds.get(kind, 10)),
+                                  file_size=len(contents[kind]))
+        api.add_file(f'media/file-{index}', contents[kind])
+        updates.append((kind, update))
+
+    load_started = time.perf_counter()
+    bot = voicebot.VoiceBot()
+    load_time = time.perf_counter() - load_started
+    Thread(target=bot.start, daemon=True, name='bot').start()
+
+    def produce():
+        for kind, update in updates:
+            message = update['message']
+            with lock:
+                started[(message['chat']['id'], message['message_id'])] = (kind, time.perf_counter())
+            api.push_update(update)
+            if args.rate:
+                time.sleep(1 / args.rate)
+
+    run_started = time.perf_counter()
+    Thread(target=produce, daemon=True, name='producer').start()
+    done.wait(args.timeout)
+    elapsed = time.perf_counter() - run_started
+    bot.bot.stop_polling()
+
+    with lock:
+        latencies = {key: finished[key] - started[key][1] for key in finished if key in started}
+    audio_seconds = sum(seconds.get(started[key][0], 0) for key in latencies)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f'model: {args.model}, updates: {args.updates}, rate: {args.rate or "burst"}, chats: {args.chats}, '
+          f'workers: {bot.transcribe_workers}, scheduler: {os.getenv("SCHEDULER_POLICY", "fifo")}')
+    print(f'bot start-up {load_time:.2f} s, completed {len(latencies)}/{args.updates} in {elapsed:.2f} s, '
+          f'errors: {len(failed)}')
+    print(f'throughput {len(latencies) / elapsed:.2f} jobs/s, {audio_seconds / elapsed:.1f} audio s/s, '
+          f'peak RSS {peak_rss:.0f} MB')
+    widths = (12, 6, 10, 10, 10)
+    print(format_row(('kind', 'jobs', 'p50, s', 'p95, s', 'p99, s'), widths))
+    for kind in kinds + ['all']:
+        values = [latency for key, latency in latencies.items() if kind == 'all' or started[key][0] == kind]
+        print(format_row((kind, len(values), f'{percentile(values, 50):.2f}', f'{percentile(values, 95):.2f}',
+                          f'{percentile(values, 99):.2f}'), widths))
+    print('API calls: ' + ', '.join(f'{method} {count}' for method, count in sorted(api.calls.items())))
+    api.shutdown()
+
+
+if __name__ == '__main__':
+    main()
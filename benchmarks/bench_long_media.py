@@ -0,0 +1,70 @@
+# benchmarks/bench_long_media.py
+"""Ускорение пакетного распознавания длинных записей и дрейф WER.
+
+Каждый файл распознаётся обычным model.transcribe (как короткие записи в боте)
+и через BatchedInferencePipeline с разными размерами пакета (как записи длиннее
+LONG_MEDIA_SECONDS). Если рядом с файлом лежит эталонная расшифровка
+<имя файла>.txt, WER считается относительно неё; дрейф — разница WER пакетного
+и последовательного режимов. Без эталона WER считается относительно
+последовательного результата.
+
+Пример:
+    python benchmarks/bench_long_media.py --model small --batch-sizes 4 8 16 lectures/*.mp3
+"""
+
+import argparse
+import os
+import time
+
+from common import format_row, word_error_rate
+from faster_whisper import BatchedInferencePipeline, decode_audio
+from main import SAMPLE_RATE, load_whisper_model
+
+
+def transcribe(transcribe_fn, audio, args, **kwargs):
+    started = time.perf_counter()
+    segments, _ = transcribe_fn(audio, language=args.language, beam_size=args.beam_size, vad_filter=True, **kwargs)
+    text = " ".join(segment.text for segment in segments)
+    return text, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='длинные аудио- или видеофайлы')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[4, 8, 16])
+    parser.add_argument('--model', default='turbo')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--compute-type', default='int8')
+    parser.add_argument('--language', default='ru')
+    parser.add_argument('--beam-size', type=int, default=5)
+    args = parser.parse_args()
+
+    model = load_whisper_model(args.device, model_size=args.model, compute_type=args.compute_type)
+    widths = (28, 8, 10, 10, 8, 8, 8)
+    print(format_row(('file', 'mode', 'audio, s', 'wall, s', 'speedup', 'WER', 'drift'), widths))
+    for path in args.files:
+        audio = decode_audio(path, sampling_rate=SAMPLE_RATE)
+        reference_path = os.path.splitext(path)[0] + '.txt'
+        reference = None
+        if os.path.exists(reference_path):
+            with open(reference_path, encoding='utf-8') as f:
+                reference = f.read()
+
+        baseline_text, baseline_time = transcribe(model.transcribe, audio, args)
+        baseline_wer = word_error_rate(reference, baseline_text) if reference else 0.0
+        name = os.path.basename(path)[:28]
+        audio_seconds = len(audio) / SAMPLE_RATE
+        print(format_row((name, 'seq', f'{audio_seconds:.0f}', f'{baseline_time:.1f}', '1.00',
+                          f'{baseline_wer:.3f}' if reference else '-', '-'), widths))
+
+        for batch_size in args.batch_sizes:
+            pipeline = BatchedInferencePipeline(model=model)
+            text, elapsed = transcribe(pipeline.transcribe, audio, args, batch_size=batch_size)
+            wer = word_error_rate(reference if reference else baseline_text, text)
+            drift = wer - baseline_wer
+            print(format_row((name, f'b{batch_size}', f'{audio_seconds:.0f}', f'{elapsed:.1f}',
+                              f'{baseline_time / elapsed:.2f}', f'{wer:.3f}', f'{drift:+.3f}'), widths))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# benchmarks/bench_scheduler.py
+"""Имитация очереди распознавания для сравнения политик планировщика.
+
+Синтетическая нагрузка: группы присылают короткие голосовые и видеосообщения
+(пуассоновский поток), а один пользователь в личном чате сразу загружает пачку
+часовых видео и документов без длительности. Время обработки задачи —
+длительность × RTF плюс накладные расходы. Для каждой политики выводятся
+p50/p95 ожидания в очереди отдельно для коротких и длинных задач.
+
+Пример:
+    python benchmarks/bench_scheduler.py --workers 2 --rtf 0.1 --starvation 900
+"""
+
+import argparse
+import heapq
+import random
+
+from common import format_row, percentile
+from main import SCHEDULERS
+
+
+def build_workload(args):
+    rng = random.Random(args.seed)
+    jobs = []
+
+    def add(arrival, chat_id, media_type, duration, reported=True):
+        jobs.append({
+            'id': len(jobs) + 1,
+            'chat_id': chat_id,
+            'media_type': media_type,
+            'duration': duration if reported else None,
+            'true_duration': duration,
+            'arrival': arrival,
+        })
+
+    for group in range(args.groups):
+        chat_id = -1000 - group
+        arrival = rng.expovariate(1 / args.interval)
+        while arrival < args.horizon:
+            if rng.random() < 0.7:
+                add(arrival, chat_id, 'voice', min(300, max(1, int(rng.lognormvariate(2.7, 0.8)))))
+            else:
+                add(arrival, chat_id, 'video_note', rng.randint(5, 60))
+            arrival += rng.expovariate(1 / args.interval)
+
+    # Пачка длинных загрузок от одного пользователя в начале интервала
+    heavy_chat = 42
+    for index in range(args.batch):
+        add(30 + index, heavy_chat, 'video', rng.randint(2400, 3600))
+    for index in range(args.batch // 2):
+        add(40 + index, heavy_chat, 'document', rng.randint(900, 1800), reported=False)
+
+    jobs.sort(key=lambda job: job['arrival'])
+    return jobs
+
+
+def simulate(policy, jobs, args):
+    now = 0.0
+    scheduler = SCHEDULERS[policy](starvation_limit=args.starvation, clock=lambda: now)
+    workers = [0.0] * args.workers
+    waits = {}
+    index = 0
+    while index < len(jobs) or len(scheduler):
+        free_at = workers[0]
+        if index < len(jobs) and (jobs[index]['arrival'] <= free_at or not len(scheduler)):
+            job = dict(jobs[index], queued_at=jobs[index]['arrival'])
+            now = job['arrival']
+            scheduler.push(job)
+            index += 1
+            continue
+        now = max(now, heapq.heappop(workers))
+        job = scheduler.pop()
+        waits[job['id']] = (job, now - job['queued_at'])
+        heapq.heappush(workers, now + job['true_duration'] * args.rtf + args.overhead)
+    return waits.values()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--rtf', type=float, default=0.1, help='время обработки / длительность аудио')
+    parser.add_argument('--overhead', type=float, default=1.0, help='накладные расходы на задачу, с')
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=120.0, help='среднее время между сообщениями в группе, с')
+    parser.add_argument('--batch', type=int, default=6, help='число длинных видео в пачке')
+    parser.add_argument('--horizon', type=float, default=3600.0, help='длительность потока сообщений, с')
+    parser.add_argument('--starvation', type=int, default=900, help='порог голодания, с (0 — выключить)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    jobs = build_workload(args)
+    short = sum(job['media_type'] in ('voice', 'video_note') for job in jobs)
+    print(f'jobs: {len(jobs)} ({short} short, {len(jobs) - short} long), workers: {args.workers}, '
+          f'rtf: {args.rtf}, starvation limit: {args.starvation} s')
+
+    widths = (12, 10, 10, 10, 10, 10, 10, 10)
+    print(format_row(('policy', 'all p50', 'all p95', 'short p50', 'short p95',
+                      'long p50', 'long p95', 'max'), widths))
+    for policy in SCHEDULERS:
+        results = list(simulate(policy, jobs, args))
+        every = [wait for _, wait in results]
+        short_waits = [wait for job, wait in results if job['media_type'] in ('voice', 'video_note')]
+        long_waits = [wait for job, wait in results if job['media_type'] not in ('voice', 'video_note')]
+        print(format_row((
+            policy,
+            f'{percentile(every, 50):.0f}', f'{percentile(every, 95):.0f}',
+            f'{percentile(short_waits, 50):.0f}', f'{percentile(short_waits, 95):.0f}',
+            f'{percentile(long_waits, 50):.0f}', f'{percentile(long_waits, 95):.0f}',
+            f'{max(every):.0f}',
+        ), widths))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# benchmarks/bench_split.py
+"""Микробенчмарк разбиения расшифровки на сообщения.
+
+Сравнивает прежний split_text (склейка слов через +=, длина в символах, без
+экранирования) с DeliveryPlanner на синтетических расшифровках в несколько
+мегабайт: с сегментами и таймкодами и без них. Для планировщика проверяется,
+что каждая часть укладывается в лимит Telegram по UTF-16 после разбора HTML и
+что после обратного разэкранирования части складываются в исходный текст.
+
+Пример:
+    python benchmarks/bench_split.py --megabytes 1 4 16
+"""
+
+import argparse
+import html
+import random
+import re
+import time
+
+from common import format_row
+
+from main import MAX_MESSAGE_LENGTH, DeliveryPlanner, utf16_length
+
+WORDS = ('привет', 'это', 'голосовое', 'сообщение', 'про', 'встречу', 'завтра', 'в', 'офисе', 'hello',
+         'a<b', 'R&D', '🙂', 'ну', 'короче', 'вот', 'значит', 'договорились')
+
+
+def legacy_split_text(text, max_length):
+    words = text.split()
+    messages = []
+    current_message = ""
+    for word in words:
+        if len(current_message) + len(word) + 1 <= max_length:
+            current_message += (" " if current_message else "") + word
+        else:
+            messages.append(current_message)
+            current_message = word
+    if current_message:
+        messages.append(current_message)
+    return messages
+
+
+def synthetic_segments(target_bytes, seed):
+    """Сегменты Whisper (начало, конец, текст) общим объёмом около target_bytes в UTF-8."""
+    rng = random.Random(seed)
+    segments = []
+    size = 0
+    now = 0.0
+    while size < target_bytes:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(4, 30))]
+        text = ' ' + ' '.join(words).capitalize() + rng.choice('..?!,')
+        duration = len(words) * 0.35
+        segments.append((now, now + duration, text))
+        now += duration + (rng.expovariate(1) if rng.random() < 0.2 else 0.05)
+        size += len(text.encode())
+    return segments
+
+
+def measure(function, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def check(chunks, text, limit):
+    for chunk in chunks:
+        visible = html.unescape(re.sub(r'</?blockquote[^>]*>', '', chunk))
+        assert utf16_length(visible) <= limit, 'part exceeds the Telegram limit'
+    joined = ' '.join(html.unescape(re.sub(r'</?blockquote[^>]*>', '', chunk)) for chunk in chunks)
+    assert joined == ' '.join(text.split()), 'parts do not add up to the transcript'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megabytes', nargs='+', type=float, default=[1, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    planner = DeliveryPlanner()
+    widths = (8, 26, 10, 10, 12)
+    print(format_row(('MB', 'splitter', 'parts', 'time, s', 'MB/s'), widths))
+    for megabytes in args.megabytes:
+        segments = synthetic_segments(int(megabytes * 1024 * 1024), args.seed)
+        text = ' '.join(segment_text for _, _, segment_text in segments)
+        size = len(text.encode()) / 1024 / 1024
+        runs = [
+            ('legacy split_text', lambda: legacy_split_text(text, MAX_MESSAGE_LENGTH)),
+            ('planner, plain text', lambda: planner.plan(text, None, max_messages=10 ** 6)),
+            ('planner, segments', lambda: planner.plan(text, segments, max_messages=10 ** 6)),
+        ]
+        for name, function in runs:
+            seconds, chunks = measure(function, args.repeat)
+            if name.startswith('planner'):
+                check(chunks, text, planner.limit)
+            print(format_row((f'{size:.1f}', name, len(chunks), f'{seconds:.3f}', f'{size / seconds:.1f}'),
+                             widths))
+
+
+if __name__ == '__main__':
+    main()
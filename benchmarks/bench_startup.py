@@ -0,0 +1,107 @@
+# benchmarks/bench_startup.py
+"""Время запуска бота: до первого принятого обновления и до первого ответа.
+
+Сравнивает загрузку модели в фоне (текущее поведение VoiceBot.start) с
+блокирующей загрузкой до начала polling, как было раньше. Каждый режим
+запускается в отдельном процессе против FakeBotApi; голосовое сообщение
+ждёт в getUpdates с момента старта процесса, как после перезапуска бота.
+
+По умолчанию модель — заглушка, загрузка которой длится --load-seconds;
+с --model tiny загружается и прогревается настоящая модель.
+
+Пример:
+    python benchmarks/bench_startup.py --load-seconds 20
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Event, Thread
+
+from common import format_row, synthetic_update
+
+MODES = ('blocking', 'background')
+
+
+def run_mode(args):
+    process_started = time.perf_counter()
+    from bench_e2e import StubModel, synthetic_wav
+    from fake_telegram import FakeBotApi
+
+    import main as voicebot
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    os.chdir(workdir)
+    os.environ.update(TELEGRAM_BOT_TOKEN='1:bench', STREAM_MODE='False', METRICS_PORT='0',
+                      JOURNAL_PATH=os.path.join(workdir, 'jobs.sqlite3'),
+                      CACHE_PATH=os.path.join(workdir, 'cache.sqlite3'))
+    os.environ.pop('WEBHOOK_URL', None)
+
+    if args.model == 'stub':
+        def load_stub(*_, **__):
+            time.sleep(args.load_seconds)
+            return StubModel(args.rtf)
+
+        voicebot.load_whisper_model = load_stub
+    else:
+        load = voicebot.load_whisper_model
+        voicebot.load_whisper_model = lambda device, **kwargs: load(device, **dict(kwargs, model_size=args.model))
+
+    answered = Event()
+    api = FakeBotApi(on_edit=lambda chat_id, message_id, text: text != 'Распознавание...'
+                      and not text.startswith('Место в очереди') and answered.set())
+    api.start()
+    api.add_file('media/file-1', synthetic_wav(args.seconds))
+    api.push_update(synthetic_update(1, 1001, 'voice', duration=int(args.seconds)))
+
+    bot = voicebot.VoiceBot()
+    if args.mode == 'blocking':
+        bot.load_models()
+    Thread(target=bot.start, daemon=True, name='bot').start()
+
+    accepted = None
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline and not answered.is_set():
+        if accepted is None and api.replies:
+            accepted = time.perf_counter() - process_started
+        time.sleep(0.005)
+    result = {
+        'mode': args.mode,
+        'accepted': accepted,
+        'answered': time.perf_counter() - process_started if answered.is_set() else None,
+        'ready': bot.model_load_seconds,
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='stub', help='stub, имя модели Whisper или путь к ней')
+    parser.add_argument('--load-seconds', type=float, default=15, help='время загрузки заглушки, с')
+    parser.add_argument('--rtf', type=float, default=0.05, help='RTF заглушки')
+    parser.add_argument('--seconds', type=float, default=5, help='длительность голосового сообщения, с')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        return run_mode(args)
+
+    widths = (12, 22, 22, 16)
+    print(format_row(('mode', 'first accepted, s', 'first answered, s', 'model load, s'), widths))
+    for mode in MODES:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode] + sys.argv[1:],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(format_row((mode, *(f'{result[key]:.2f}' if result[key] is not None else '-'
+                                  for key in ('accepted', 'answered', 'ready'))), widths))
+
+
+if __name__ == '__main__':
+    main()
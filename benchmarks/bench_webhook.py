@@ -0,0 +1,98 @@
+# benchmarks/bench_webhook.py
+"""Пропускная способность приёма обновлений через встроенный webhook-сервер.
+
+Поднимает WebhookServer на локальном порту, подключает к нему telebot.TeleBot
+с обработчиками-заглушками и отправляет синтетические обновления из нескольких
+клиентских потоков. Telegram не нужен: токен фиктивный, обработчики в API не ходят.
+
+Пример:
+    python benchmarks/bench_webhook.py --updates 5000 --clients 8 --handler-ms 5
+"""
+
+import argparse
+import http.client
+import json
+import time
+from threading import Event, Lock, Thread
+
+import telebot
+from common import percentile, synthetic_update
+from main import WebhookServer
+
+SECRET = 'bench-secret'
+PATH = '/webhook'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=8, help='параллельные HTTP-клиенты')
+    parser.add_argument('--bot-threads', type=int, default=4, help='размер пула обработчиков telebot')
+    parser.add_argument('--handler-ms', type=float, default=0.0, help='имитация работы обработчика, мс')
+    args = parser.parse_args()
+
+    bot = telebot.TeleBot('1:bench', num_threads=args.bot_threads)
+    handled = 0
+    handled_lock = Lock()
+    all_handled = Event()
+
+    @bot.message_handler(content_types=['voice', 'video_note', 'document'])
+    def handle(message):
+        nonlocal handled
+        if args.handler_ms:
+            time.sleep(args.handler_ms / 1000)
+        with handled_lock:
+            handled += 1
+            if handled == args.updates:
+                all_handled.set()
+
+    def on_update(body):
+        bot.process_new_updates([telebot.types.Update.de_json(body)])
+
+    server = WebhookServer('127.0.0.1', 0, PATH, SECRET, on_update)
+    server.start()
+
+    kinds = ('voice', 'video_note', 'document')
+    bodies = [json.dumps(synthetic_update(i + 1, -1000 - i % 50, kinds[i % len(kinds)]))
+              for i in range(args.updates)]
+    latencies = []
+    latencies_lock = Lock()
+    errors = []
+
+    def client(indices):
+        connection = http.client.HTTPConnection('127.0.0.1', server.port)
+        local = []
+        for index in indices:
+            started = time.perf_counter()
+            connection.request('POST', PATH, body=bodies[index], headers={
+                'Content-Type': 'application/json', WebhookServer.SECRET_HEADER: SECRET})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            local.append(time.perf_counter() - started)
+        connection.close()
+        with latencies_lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    threads = [Thread(target=client, args=(range(i, args.updates, args.clients),)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    accepted = time.perf_counter() - started
+    all_handled.wait(timeout=60)
+    finished = time.perf_counter() - started
+    server.shutdown()
+
+    print(f'updates: {args.updates}, clients: {args.clients}, bot threads: {args.bot_threads}, '
+          f'handler: {args.handler_ms} ms, errors: {len(errors)}')
+    print(f'accepted in {accepted:.2f} s ({args.updates / accepted:.0f} updates/s)')
+    print(f'handled {handled} in {finished:.2f} s ({handled / finished:.0f} updates/s)')
+    print(f'POST latency p50 {percentile(latencies, 50) * 1000:.2f} ms, '
+          f'p95 {percentile(latencies, 95) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
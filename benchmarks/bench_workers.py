@@ -0,0 +1,90 @@
+# benchmarks/bench_workers.py
+"""Сравнение пропускной способности и задержки пула воркеров распознавания.
+
+Все файлы ставятся в очередь одновременно (пиковая нагрузка), после чего пул
+из N воркеров разбирает её так же, как VoiceBot.voice_handler.
+
+Пример:
+    python benchmarks/bench_workers.py --model tiny --configs 1x1 4x1 4x4 samples/*.ogg
+"""
+
+import argparse
+import os
+import time
+from threading import Thread
+
+from common import format_row, percentile
+from faster_whisper import decode_audio
+from main import SAMPLE_RATE, ChatManager, load_whisper_model
+
+
+def run_config(files, workers, replicas, args):
+    cpu_threads = args.cpu_threads or max(1, (os.cpu_count() or 1) // workers)
+    workers_per_replica = -(-workers // replicas)
+    models = [
+        load_whisper_model(args.device, num_workers=workers_per_replica, cpu_threads=cpu_threads,
+                           model_size=args.model, compute_type=args.compute_type)
+        for _ in range(replicas)
+    ]
+    chat_manager = ChatManager()
+    latencies = []
+
+    def worker(model):
+        while True:
+            job = chat_manager.take_chat()
+            if job['path'] is None:
+                chat_manager.finish_chat(job)
+                break
+            audio = decode_audio(job['path'], sampling_rate=SAMPLE_RATE)
+            segments, _ = model.transcribe(audio, language=args.language,
+                                           beam_size=5, vad_filter=True)
+            " ".join(segment.text for segment in segments)
+            latencies.append(time.time() - job['queued_at'])
+            chat_manager.finish_chat(job)
+
+    started = time.time()
+    for index in range(args.repeat):
+        for path in files:
+            chat_manager.add_chat(0, index, path)
+    # Пустой path — сигнал остановки для каждого воркера
+    for _ in range(workers):
+        chat_manager.add_chat(0, -1, None)
+
+    threads = [Thread(target=worker, args=(models[i % replicas],)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return elapsed, latencies, cpu_threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='аудиофайлы для распознавания')
+    parser.add_argument('--configs', nargs='+', default=['1x1', '2x1', '2x2'],
+                        help='конфигурации вида <воркеры>x<реплики>; 1x1 — текущая схема')
+    parser.add_argument('--repeat', type=int, default=2, help='сколько раз поставить каждый файл в очередь')
+    parser.add_argument('--model', default='turbo')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--compute-type', default='int8')
+    parser.add_argument('--cpu-threads', type=int, default=0, help='0 — делить ядра между воркерами')
+    parser.add_argument('--language', default='ru')
+    args = parser.parse_args()
+
+    audio_seconds = args.repeat * sum(
+        len(decode_audio(path, sampling_rate=SAMPLE_RATE)) / SAMPLE_RATE for path in args.files)
+    jobs = len(args.files) * args.repeat
+    widths = (8, 8, 10, 10, 10, 10, 10)
+    print(format_row(('config', 'threads', 'wall, s', 'jobs/s', 'audio x', 'p50, s', 'p95, s'), widths))
+    for config in args.configs:
+        workers, replicas = (int(part) for part in config.split('x'))
+        elapsed, latencies, cpu_threads = run_config(args.files, workers, min(replicas, workers), args)
+        print(format_row((
+            config, cpu_threads, f'{elapsed:.2f}', f'{jobs / elapsed:.3f}', f'{audio_seconds / elapsed:.2f}',
+            f'{percentile(latencies, 50):.2f}', f'{percentile(latencies, 95):.2f}',
+        ), widths))
+
+
+if __name__ == '__main__':
+    main()
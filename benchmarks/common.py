@@ -0,0 +1,72 @@
+# benchmarks/common.py
+
+import os
+import re
+import sys
+
+import numpy as np
+
+# Бенчмарки запускаются как скрипты: делаем main.py импортируемым из корня репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) с линейной интерполяцией."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def word_error_rate(reference, hypothesis):
+    """WER по словам без учёта регистра и пунктуации."""
+    ref = re.findall(r'\w+', reference.lower())
+    hyp = re.findall(r'\w+', hypothesis.lower())
+    if not ref:
+        return float(bool(hyp))
+    # Расстояние Левенштейна построчно; вставки внутри строки сворачиваются через накопительный минимум
+    hyp_ids = {word: index for index, word in enumerate(set(hyp))}
+    hyp_vector = np.array([hyp_ids[word] for word in hyp], dtype=np.int64)
+    offsets = np.arange(len(hyp) + 1)
+    previous = offsets.copy()
+    for row, word in enumerate(ref, start=1):
+        substitution = previous[:-1] + (hyp_vector != hyp_ids.get(word, -1))
+        current = np.empty_like(previous)
+        current[0] = row
+        current[1:] = np.minimum(previous[1:] + 1, substitution)
+        previous = np.minimum.accumulate(current - offsets) + offsets
+    return previous[-1] / len(ref)
+
+
+def format_row(columns, widths):
+    return '  '.join(str(column).ljust(width) for column, width in zip(columns, widths))
+
+
+def synthetic_update(update_id, chat_id, kind='voice', duration=5, file_size=32000, chat_type=None):
+    """Обновление Telegram Bot API в виде dict с сообщением указанного типа."""
+    message = {
+        'message_id': update_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': chat_type or ('private' if chat_id > 0 else 'supergroup')},
+        'from': {'id': abs(chat_id), 'is_bot': False, 'first_name': 'Bench'},
+    }
+    media = {'file_id': f'file-{update_id}', 'file_unique_id': f'unique-{update_id}', 'file_size': file_size}
+    if kind == 'text':
+        message['text'] = '/check'
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+    elif kind == 'voice':
+        message['voice'] = dict(media, duration=duration, mime_type='audio/ogg')
+    elif kind == 'video_note':
+        message['video_note'] = dict(media, duration=duration, length=240)
+    elif kind == 'audio':
+        message['audio'] = dict(media, duration=duration, mime_type='audio/mpeg', file_name='audio.mp3')
+    elif kind == 'video':
+        message['video'] = dict(media, duration=duration, width=640, height=360, mime_type='video/mp4')
+    elif kind == 'document':
+        message['document'] = dict(media, mime_type='audio/ogg', file_name='document.ogg')
+    else:
+        raise ValueError(f'Unknown update kind: {kind}')
+    return {'update_id': update_id, 'message': message}
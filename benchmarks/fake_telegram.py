@@ -0,0 +1,139 @@
+# benchmarks/fake_telegram.py
+"""Локальная замена Bot API для офлайн-бенчмарков.
+
+Отвечает на getUpdates (long polling), getFile, sendMessage, editMessageText и
+sendDocument, отдаёт файлы по /file/bot<token>/<path>. Остальные методы
+возвращают true. Для каждого статусного сообщения бота запоминается, на какое
+входящее сообщение оно отвечает, чтобы бенчмарк мог измерить задержку до ответа.
+"""
+
+import itertools
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+from urllib.parse import parse_qs, urlsplit
+
+import telebot
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class FakeBotApi:
+    MAX_POLL_WAIT = 0.5
+
+    def __init__(self, on_edit=None, host='127.0.0.1', port=0):
+        self.on_edit = on_edit
+        self.files = {}
+        self.calls = {}
+        self._updates = []
+        self._updates_changed = Condition()
+        self._message_ids = itertools.count(1_000_000)
+        # Статусное сообщение бота -> (chat_id, message_id входящего сообщения)
+        self.replies = {}
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                parts = url.path.strip('/').split('/')
+                if parts[0] == 'file':
+                    content = api.files.get('/'.join(parts[2:]))
+                    if content is None:
+                        return self._respond(404, b'')
+                    return self._respond(200, content, 'application/octet-stream')
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+                result = api.handle(parts[-1], params)
+                self._respond(200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+
+            def _respond(self, status, content, content_type='text/plain'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        """Запускает сервер и перенаправляет на него telebot и DownloadManager."""
+        Thread(target=self.httpd.serve_forever, daemon=True, name='fake-bot-api').start()
+        base = f'http://127.0.0.1:{self.port}'
+        telebot.apihelper.API_URL = base + '/bot{0}/{1}'
+        telebot.apihelper.FILE_URL = base + '/file/bot{0}/{1}'
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_file(self, file_path, content):
+        self.files[file_path] = content
+
+    def push_update(self, update):
+        with self._updates_changed:
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+
+    def handle(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            file_id = params['file_id']
+            file_path = f'media/{file_id}'
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_path': file_path,
+                    'file_size': len(self.files.get(file_path, b''))}
+        if method in ('sendMessage', 'sendDocument'):
+            chat_id = int(params['chat_id'])
+            message_id = next(self._message_ids)
+            reply_to = params.get('reply_to_message_id')
+            if 'reply_parameters' in params:
+                reply_to = json.loads(params['reply_parameters']).get('message_id')
+            if reply_to is not None:
+                self.replies[(chat_id, message_id)] = (chat_id, int(reply_to))
+            return self._message(chat_id, message_id, params.get('text', ''))
+        if method == 'editMessageText':
+            chat_id = int(params['chat_id'])
+            message_id = int(params['message_id'])
+            if self.on_edit:
+                self.on_edit(chat_id, message_id, params.get('text', ''))
+            return self._message(chat_id, message_id, params.get('text', ''))
+        return True
+
+    def _get_updates(self, offset, timeout):
+        deadline = time.monotonic() + min(timeout, self.MAX_POLL_WAIT)
+        with self._updates_changed:
+            while True:
+                # Подтверждённые клиентом обновления больше не нужны
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if self._updates or remaining <= 0:
+                    return self._updates[:100]
+                self._updates_changed.wait(remaining)
+
+    @staticmethod
+    def _message(chat_id, message_id, text):
+        return {'message_id': message_id, 'date': int(time.time()), 'text': text, 'from': BOT_USER,
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}}
@@ -3,83 +3,2358 @@
 import os
 import logging
 import time
-from threading import Thread
-
+import bisect
+import cProfile
+import gc
+import itertools
+import heapq
+import hashlib
+import hmac
+import io
+import json
+import re
+import secrets
+import sqlite3
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Lock, Thread, get_ident, local
+from threading import enumerate as threading_enumerate
+
+import av
+import numpy as np
+import requests
 import telebot
-from telebot.formatting import hcite
-from pydub import AudioSegment
-from faster_whisper import WhisperModel
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter as MetricCounter, Histogram
+from prometheus_client import ProcessCollector, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from telebot.formatting import escape_html
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import redis
+except ImportError:  # Нужен только для QUEUE_URL=redis://...
+    redis = None
+
+
+SAMPLE_RATE = 16000
+MAX_MESSAGE_LENGTH = 3696  # Максимальная длина сообщения с запасом под HTML
+TELEGRAM_TEXT_LIMIT = 4096  # Лимит Bot API на текст сообщения после разбора разметки, в UTF-16
+DECODE_CHUNK_SAMPLES = 500000  # Порция декодирования в отсчётах исходной частоты
+MAX_MENTIONS_PER_MESSAGE = 50  # Больше упоминаний в одном сообщении Telegram не уведомляет
+# chat_member не приходит без явного запроса; по нему сбрасывается кэш администраторов
+ALLOWED_UPDATES = ['message', 'my_chat_member', 'chat_member']
+PARTIAL_TAIL_SEGMENTS = 256  # Сколько последних сегментов держать для показа промежуточного текста
+FINGERPRINT_FRAME = 4096  # Окно отпечатка, отсчётов (256 мс)
+FINGERPRINT_HOP = 2048
+FINGERPRINT_BAND_EDGES = np.geomspace(300, 2000, 34)  # 33 полосы — 32 бита на кадр
+FINGERPRINT_MIN_FRAMES = 16  # Отпечатки записей короче ~2 с ненадёжны
+FINGERPRINT_SILENCE_RMS = 1e-3  # Кадры тише −60 дБ в сравнении не участвуют
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+QUEUE_UPDATE_TICK = 5  # Период пересчёта ETA, с
+QUEUE_UPDATE_API_SHARE = 0.2  # Доля общего лимита Bot API на обновления позиции в очереди
+INTERRUPTED_TEXT = 'Обработка прервана перезапуском бота. Отправьте файл ещё раз.'
+UNKNOWN_MEDIA_DURATION = 300  # Оценка для документов, для которых Telegram не сообщает длительность
+
+
+_current = local()
+
+
+def current_job_id():
+    """id задачи, которую обрабатывает текущий поток, или None."""
+    return getattr(_current, 'job_id', None)
 
 
-def setup_logging(filename: str) -> None:
+def set_current_job(job_id):
+    _current.job_id = job_id
+
+
+class JobLogFilter(logging.Filter):
+    """Добавляет к записям лога id текущей задачи (поле job_id)."""
+
+    def filter(self, record):
+        job_id = current_job_id()
+        record.job_id = '-' if job_id is None else job_id
+        return True
+
+
+def setup_logging(filename: str, job_ids: bool = False) -> None:
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    # В режиме профилирования каждая строка помечается id задачи
+    if job_ids:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - [job %(job_id)s] %(message)s')
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
     file_handler = logging.FileHandler(filename, 'a')
     file_handler.setFormatter(formatter)
+    file_handler.addFilter(JobLogFilter())
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
+    console_handler.addFilter(JobLogFilter())
 
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
 
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.error(f'Invalid {name}: {value!r}. It should be an integer, using {default}.')
+        return default
+
+
+def estimated_duration(job):
+    return job.get('duration') or UNKNOWN_MEDIA_DURATION
+
+
+def media_label(job):
+    return job.get('media_type') or 'unknown'
+
+
+def utf16_length(text):
+    """Длина строки так, как её считает Telegram: в кодовых единицах UTF-16."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def join_segments(segments):
+    return " ".join(segment[2] for segment in segments)
+
+
+def format_timestamp(seconds, separator):
+    """Таймкод ЧЧ:ММ:СС<separator>ммм для субтитров: запятая в SRT, точка в WebVTT."""
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+
+def format_eta(seconds):
+    """Округлённое время для пользователя: чем дальше, тем грубее, чтобы текст менялся реже."""
+    minutes = seconds / 60
+    if minutes < 1:
+        return "меньше минуты"
+    if minutes < 10:
+        return f"~{round(minutes)} мин"
+    if minutes < 60:
+        return f"~{round(minutes / 5) * 5} мин"
+    hours, minutes = divmod(round(minutes / 15) * 15, 60)
+    return f"~{hours} ч {minutes} мин" if minutes else f"~{hours} ч"
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return 0
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def decode_pcm(path, expected_seconds=None):
+    """Декодирует файл в 16 кГц моно float32 прямо в заранее выделенный буфер.
+
+    faster_whisper.decode_audio собирает всю запись в int16, а затем делает из неё
+    две копии во float32 — пик около 10 байт на отсчёт. Здесь порции ограниченного
+    размера переводятся во float32 сразу в буфер, размер которого оценивается по
+    длительности, так что пик памяти — сам результат (около 4 байт на отсчёт).
+    Результат совпадает с decode_audio отсчёт в отсчёт.
+    """
+    # s16, как в faster_whisper: при выводе во float FFmpeg сводит каналы без нормировки
+    resampler = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=SAMPLE_RATE)
+    with av.open(path, mode='r', metadata_errors='ignore') as container:
+        if not expected_seconds and container.duration:
+            expected_seconds = container.duration / av.time_base
+        buffer = np.empty(int((expected_seconds or 60) * SAMPLE_RATE) + SAMPLE_RATE, dtype=np.float32)
+        size = 0
+
+        def append(frames):
+            nonlocal buffer, size
+            for frame in frames:
+                samples = frame.to_ndarray().reshape(-1)
+                if size + len(samples) > len(buffer):
+                    grown = np.empty(max(size + len(samples), len(buffer) * 3 // 2), dtype=np.float32)
+                    grown[:size] = buffer[:size]
+                    buffer = grown
+                np.multiply(samples, 1 / 32768.0, out=buffer[size:size + len(samples)], casting='unsafe')
+                size += len(samples)
+
+        # Кадры копятся в FIFO ограниченного размера и ресэмплируются крупными порциями:
+        # по одному кадру ресэмплер работает в разы медленнее
+        fifo = av.audio.fifo.AudioFifo()
+        frames = container.decode(audio=0)
+        while True:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                break
+            except av.error.InvalidDataError:
+                continue
+            frame.pts = None
+            fifo.write(frame)
+            if fifo.samples >= DECODE_CHUNK_SAMPLES:
+                append(resampler.resample(fifo.read()))
+        if fifo.samples:
+            append(resampler.resample(fifo.read()))
+        append(resampler.resample(None))
+    # Ресэмплер PyAV освобождает нативные буферы только при сборке мусора
+    del resampler
+    gc.collect()
+    if len(buffer) - size > SAMPLE_RATE * 10:
+        return buffer[:size].copy()
+    return buffer[:size]
+
+
+def audio_fingerprint(audio, seconds):
+    """Акустический отпечаток первых seconds секунд записи: 32 бита на кадр (uint32) и маска тишины.
+
+    Бит — знак разности энергий соседних частотных полос, продифференцированной по
+    времени (схема Haitsma–Kalker): отпечаток не зависит от громкости и почти не
+    меняется при перекодировании. В тишине биты случайны или нулевые, поэтому такие
+    кадры помечаются и не сравниваются. Считается целиком векторно. None — запись слишком короткая.
+    """
+    clip = audio[:int(seconds * SAMPLE_RATE)]
+    if len(clip) < FINGERPRINT_FRAME + FINGERPRINT_HOP * FINGERPRINT_MIN_FRAMES:
+        return None
+    frames = np.lib.stride_tricks.sliding_window_view(clip, FINGERPRINT_FRAME)[::FINGERPRINT_HOP]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FINGERPRINT_FRAME).astype(np.float32), axis=1)) ** 2
+    edges = np.round(FINGERPRINT_BAND_EDGES * FINGERPRINT_FRAME / SAMPLE_RATE).astype(np.int64)
+    energy = np.add.reduceat(spectrum[:, edges[0]:edges[-1]], edges[:-1] - edges[0], axis=1)
+    bands = energy[:, :-1] - energy[:, 1:]
+    bits = bands[1:] - bands[:-1] > 0
+    quiet = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1)) < FINGERPRINT_SILENCE_RMS
+    codes = np.packbits(bits, axis=1, bitorder='little').view('<u4')[:, 0].copy()
+    return codes, quiet[1:] | quiet[:-1]
+
+
+def load_whisper_model(device: str, num_workers: int = 1, cpu_threads: int = 0,
+                       model_size: str = "turbo", compute_type: str = "int8") -> WhisperModel:
+    # download_root позволяет указать путь для кэширования моделей.
+    return WhisperModel(
+        model_size_or_path=model_size,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=num_workers,
+        download_root="./model_cache" # Опционально, папка для кэша моделей внутри контейнера
+    )
+
+
+class Scheduler:
+    """Политика выдачи задач воркерам; базовая — строгий FIFO.
+
+    Все политики защищены от голодания: задача, прождавшая в очереди дольше
+    starvation_limit секунд, выдаётся раньше остальных.
+    """
+
+    name = 'fifo'
+
+    def __init__(self, starvation_limit=0, clock=time.time):
+        self.starvation_limit = starvation_limit
+        self.clock = clock
+        # Все ожидающие задачи в порядке постановки: id -> задача
+        self._arrivals = OrderedDict()
+
+    def __len__(self):
+        return len(self._arrivals)
+
+    def push(self, job):
+        self._arrivals[job['id']] = job
+        self._push(job)
+
+    def peek(self):
+        if not self._arrivals:
+            return None
+        oldest = next(iter(self._arrivals.values()))
+        if self._is_starving(oldest, self.clock()):
+            return oldest
+        return self._peek()
+
+    def pop(self):
+        job = self.peek()
+        if job is not None:
+            del self._arrivals[job['id']]
+            self._remove(job)
+        return job
+
+    def remove(self, job):
+        """Убирает задачу из очереди вне порядка политики (структуры политик чистятся лениво)."""
+        del self._arrivals[job['id']]
+
+    def ordered(self):
+        """Ожидающие задачи в том порядке, в каком их получат воркеры при текущем состоянии очереди."""
+        now = self.clock()
+        starving = list(itertools.takewhile(lambda job: self._is_starving(job, now), self._arrivals.values()))
+        skipped = {job['id'] for job in starving}
+        return starving + [job for job in self._ordered() if job['id'] not in skipped]
+
+    def _is_starving(self, job, now):
+        return bool(self.starvation_limit) and now - (job['queued_at'] or now) >= self.starvation_limit
+
+    def _push(self, job):
+        pass
+
+    def _peek(self):
+        return next(iter(self._arrivals.values()))
+
+    def _remove(self, job):
+        pass
+
+    def _ordered(self):
+        return list(self._arrivals.values())
+
+
+class RoundRobinScheduler(Scheduler):
+    """По очереди берёт по одной задаче из каждого чата."""
+
+    name = 'round_robin'
+
+    def __init__(self, starvation_limit=0, clock=time.time):
+        super().__init__(starvation_limit, clock)
+        self._chats = OrderedDict()
+
+    def _push(self, job):
+        self._chats.setdefault(job['chat_id'], deque()).append(job)
+
+    def _peek(self):
+        while self._chats:
+            chat_id, jobs = next(iter(self._chats.items()))
+            self._drop_stale(jobs)
+            if jobs:
+                return jobs[0]
+            del self._chats[chat_id]
+        return None
+
+    def _remove(self, job):
+        # Внутри чата порядок FIFO, поэтому выданная задача — всегда первая живая в своём чате
+        jobs = self._chats.get(job['chat_id'])
+        if jobs is None:
+            return
+        self._drop_stale(jobs)
+        if jobs and jobs[0] is job:
+            jobs.popleft()
+        if jobs:
+            self._chats.move_to_end(job['chat_id'])
+        else:
+            del self._chats[job['chat_id']]
+
+    def _ordered(self):
+        queues = [[job for job in jobs if job['id'] in self._arrivals] for jobs in self._chats.values()]
+        return [job for round_jobs in itertools.zip_longest(*queues) for job in round_jobs if job is not None]
+
+    def _drop_stale(self, jobs):
+        while jobs and jobs[0]['id'] not in self._arrivals:
+            jobs.popleft()
+
+
+class HeapScheduler(Scheduler):
+    """Очередь с приоритетом по ключу _key; при равных ключах — FIFO."""
+
+    def __init__(self, starvation_limit=0, clock=time.time):
+        super().__init__(starvation_limit, clock)
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def _key(self, job):
+        raise NotImplementedError
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (self._key(job), next(self._sequence), job))
+
+    def _peek(self):
+        # Задачи, выданные вне очереди из-за голодания, удаляются из кучи лениво
+        while self._heap and self._heap[0][2]['id'] not in self._arrivals:
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    def _remove(self, job):
+        if self._heap and self._heap[0][2] is job:
+            heapq.heappop(self._heap)
+
+    def _ordered(self):
+        return [entry[2] for entry in sorted(self._heap, key=lambda entry: entry[:2])
+                if entry[2]['id'] in self._arrivals]
+
+
+class ShortestJobFirstScheduler(HeapScheduler):
+    """Сначала короткие задачи по длительности, которую сообщает Telegram."""
+
+    name = 'sjf'
+    # Документы приходят без длительности — считаем их длинными
+    UNKNOWN_DURATION = 3600
+
+    def _key(self, job):
+        return job.get('duration') or self.UNKNOWN_DURATION
+
+
+class MediaPriorityScheduler(HeapScheduler):
+    """Голосовые и видеосообщения обрабатываются раньше аудио, видео и документов."""
+
+    name = 'priority'
+
+    def _key(self, job):
+        return 0 if job['media_type'] in ('voice', 'video_note') else 1
+
+
+SCHEDULERS = {
+    scheduler.name: scheduler
+    for scheduler in (Scheduler, RoundRobinScheduler, ShortestJobFirstScheduler, MediaPriorityScheduler)
+}
+
+
 class ChatManager:
-    def __init__(self):
-        logging.info('Initializing chat manager')
-        self.chat_data = []
+    """Потокобезопасная очередь задач распознавания с учётом состояния каждой задачи."""
 
-    def add_chat(self, chat_id, message_id, path):
-        logging.info('Adding new chat to queue')
-        self.chat_data.append({
-            "chat_id": chat_id,
-            "message_id": message_id,
-            "path": path
-        })
+    STATES = ('downloading', 'queued', 'transcribing', 'sending')
+    DISPLAY_LIMIT = 20
+
+    def __init__(self, journal=None, scheduler=None):
+        logging.info('Initializing chat manager')
+        # Порядок выдачи задач определяет политика планировщика (по умолчанию FIFO)
+        self.chat_data = scheduler if scheduler is not None else Scheduler()
+        self.active_jobs = {}
+        self.state_counts = Counter()
+        # Суммарная длительность ожидающих записей в секундах — основа оценки отставания
+        self.queued_seconds = 0.0
+        self.journal = journal
+        self._job_ids = itertools.count(1)
+        self._condition = Condition()
+
+    def start_download(self, chat_id, message_id, media_type=None, **fields):
+        """Регистрирует задачу, файл которой ещё скачивается."""
+        job = self._new_job(chat_id, message_id, None, 'downloading', media_type, **fields)
+        with self._condition:
+            self.active_jobs[job['id']] = job
+            self.state_counts['downloading'] += 1
+        return job
+
+    def resume(self, job, state):
+        """Возвращает в учёт задачу из журнала, которая продолжится не из очереди: её файл
+        скачивается заново (downloading) или её уже распознаёт воркер раздельного режима (transcribing)."""
+        with self._condition:
+            job['state'] = state
+            self.active_jobs[job['id']] = job
+            self.state_counts[state] += 1
+
+    def save(self, job):
+        """Записывает в журнал поля задачи, изменённые вне ChatManager."""
+        if self.journal:
+            self.journal.update(job)
+
+    def add_chat(self, chat_id, message_id, path, job=None, media_type=None):
+        logging.debug('Adding new chat to queue')
+        with self._condition:
+            if job is None:
+                job = self._new_job(chat_id, message_id, path, 'queued', media_type)
+            else:
+                self.active_jobs.pop(job['id'], None)
+                self.state_counts[job['state']] -= 1
+                job['path'] = path
+                job['state'] = 'queued'
+            job['queued_at'] = time.time()
+            if self.journal:
+                self.journal.update(job)
+            self.chat_data.push(job)
+            self.state_counts['queued'] += 1
+            self.queued_seconds += estimated_duration(job)
+            # Будим всех: среди ожидающих может быть воркер, добирающий пакет
+            self._condition.notify_all()
+        return job
+
+    def take_chat(self, timeout=None):
+        """Блокируется до появления задачи, извлекает её из очереди и помечает как распознаваемую."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.chat_data, timeout):
+                return None
+            job = self.chat_data.pop()
+            self.state_counts['queued'] -= 1
+            self.queued_seconds -= estimated_duration(job)
+            job['state'] = 'transcribing'
+            job['started_at'] = time.time()
+            self.state_counts['transcribing'] += 1
+            self.active_jobs[job['id']] = job
+            if self.journal:
+                self.journal.update(job)
+            return job
+
+    def take_batch(self, first, predicate, limit, max_wait):
+        """Добирает к задаче first ожидающие задачи, подходящие под predicate, пока пакет
+        не заполнится до limit или не истечёт max_wait секунд."""
+        batch = [first]
+        deadline = time.monotonic() + max_wait
+        with self._condition:
+            while True:
+                for job in self.chat_data.ordered():
+                    if len(batch) >= limit:
+                        break
+                    if predicate(job):
+                        self.chat_data.remove(job)
+                        self.state_counts['queued'] -= 1
+                        self.queued_seconds -= estimated_duration(job)
+                        job['state'] = 'transcribing'
+                        job['started_at'] = time.time()
+                        self.state_counts['transcribing'] += 1
+                        self.active_jobs[job['id']] = job
+                        if self.journal:
+                            self.journal.update(job)
+                        batch.append(job)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= limit or remaining <= 0:
+                    return batch
+                self._condition.wait(remaining)
+
+    def restore_chat(self, job):
+        """Возвращает в очередь задачу, восстановленную из журнала после перезапуска."""
+        with self._condition:
+            job['state'] = 'queued'
+            self.chat_data.push(job)
+            self.state_counts['queued'] += 1
+            self.queued_seconds += estimated_duration(job)
+            self._condition.notify()
+
+    def set_state(self, job, state):
+        with self._condition:
+            if job['id'] not in self.active_jobs:
+                return
+            self.state_counts[job['state']] -= 1
+            job['state'] = state
+            self.state_counts[state] += 1
+
+    def finish_chat(self, job):
+        """Удаляет завершённую (или сорвавшуюся) задачу из учёта."""
+        with self._condition:
+            if self.active_jobs.pop(job['id'], None) is not None:
+                self.state_counts[job['state']] -= 1
+                if self.journal:
+                    self.journal.remove(job['id'])
+
+    def cancel_download(self, job):
+        """Снимает с учёта задачу, чей файл так и не был поставлен в очередь."""
+        if job is None:
+            return
+        with self._condition:
+            if job['state'] == 'downloading' and self.active_jobs.pop(job['id'], None) is not None:
+                self.state_counts['downloading'] -= 1
+                if self.journal:
+                    self.journal.remove(job['id'])
 
     def remove_chat(self):
-        logging.info('Removing first chat from queue')
-        if self.chat_data:
-            self.chat_data.pop(0)
+        logging.debug('Removing first chat from queue')
+        with self._condition:
+            if self.chat_data:
+                job = self.chat_data.pop()
+                self.state_counts['queued'] -= 1
+                self.queued_seconds -= estimated_duration(job)
+                if self.journal:
+                    self.journal.remove(job['id'])
 
     def display_chats(self):
-        logging.info('Displaying all chats in queue')
-        if not self.chat_data:
-            return "No chats in queue"
-        else:
-            result = ""
-            for item in self.chat_data:
-                result += f"Chat: {item['chat_id']}, Message: {item['message_id']}, Path: {item['path']}\n"
-            return result.strip()
+        logging.debug('Displaying all chats in queue')
+        with self._condition:
+            if not self.chat_data and not self.active_jobs:
+                return "No chats in queue"
+            lines = []
+            jobs = itertools.chain(self.active_jobs.values(), self.chat_data.ordered())
+            for item in itertools.islice(jobs, self.DISPLAY_LIMIT):
+                lines.append(f"Chat: {item['chat_id']}, Message: {item['message_id']}, "
+                             f"State: {item['state']}, Path: {item['path']}")
+            total = len(self.chat_data) + len(self.active_jobs)
+            if total > self.DISPLAY_LIMIT:
+                lines.append(f"... and {total - self.DISPLAY_LIMIT} more")
+            lines.append(', '.join(f"{state}: {self.state_counts[state]}" for state in self.STATES))
+            return "\n".join(lines)
+
+    def snapshot(self):
+        """Копия очереди ожидающих задач для безопасного обхода из других потоков."""
+        with self._condition:
+            return self.chat_data.ordered()
+
+    def get_job(self, job_id):
+        with self._condition:
+            return self.active_jobs.get(job_id)
+
+    def active(self):
+        """Копия списка задач в работе (скачиваются, распознаются или отправляются)."""
+        with self._condition:
+            return list(self.active_jobs.values())
 
     def get_first_chat(self):
-        logging.info('Getting first chat in queue')
-        if self.chat_data:
-            return self.chat_data[0]
-        else:
-            return None
+        logging.debug('Getting first chat in queue')
+        with self._condition:
+            if self.chat_data:
+                return self.chat_data.peek()
+            else:
+                return None
+
+    def depth_by_media(self):
+        """Число задач по парам (состояние, тип медиа) — для метрик глубины очереди."""
+        with self._condition:
+            jobs = itertools.chain(self.chat_data.ordered(), self.active_jobs.values())
+            return Counter((job['state'], media_label(job)) for job in jobs)
 
     def count_chats(self):
-        return len(self.chat_data)
+        with self._condition:
+            return len(self.chat_data) + len(self.active_jobs)
 
     def is_empty(self):
-        return len(self.chat_data) == 0
+        return not self.chat_data
+
+    def _new_job(self, chat_id, message_id, path, state, media_type, **fields):
+        job = {
+            "id": None,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "path": path,
+            "media_type": media_type,
+            "state": state,
+            "queued_at": None,
+        }
+        job.update(fields)
+        if self.journal:
+            job['id'] = self.journal.insert(job)
+        else:
+            job['id'] = next(self._job_ids)
+        return job
+
+
+class JobJournal:
+    """Журнал незавершённых задач на SQLite: позволяет продолжить очередь после перезапуска."""
+
+    def __init__(self, path):
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT NOT NULL, data TEXT NOT NULL)'
+            )
+        # WAL + synchronous=NORMAL: запись не ждёт fsync на каждый коммит, но журнал не портится при падении
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        logging.info(f'Job journal opened: {path}')
+
+    def insert(self, job):
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO jobs (state, data) VALUES (?, ?)', (job['state'], self._serialize(job)))
+            return cursor.lastrowid
+
+    def update(self, job):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'UPDATE jobs SET state = ?, data = ? WHERE id = ?', (job['state'], self._serialize(job), job['id']))
+
+    def remove(self, job_id):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def unfinished(self):
+        """Все задачи из журнала в порядке постановки."""
+        with self._lock:
+            rows = self._connection.execute('SELECT id, state, data FROM jobs ORDER BY id').fetchall()
+        jobs = []
+        for job_id, state, data in rows:
+            job = json.loads(data)
+            job['id'] = job_id
+            job['state'] = state
+            jobs.append(job)
+        return jobs
+
+    @staticmethod
+    def _serialize(job):
+        return json.dumps({key: value for key, value in job.items() if key not in ('id', 'state')})
+
+
+class SQLiteJobQueue:
+    """Общая очередь раздельного режима на SQLite: ingest-процесс кладёт задачи, воркеры
+    забирают их с арендой и публикуют результаты.
+
+    Подходит для процессов на одном хосте или с общим томом и заменяет RedisJobQueue
+    там, где Redis нет: интерфейс у них один. Задача, аренда которой истекла (воркер
+    упал), снова выдаётся другому воркеру, но не больше MAX_ATTEMPTS раз.
+    """
+
+    POLL_INTERVAL = 0.2
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, path, lease):
+        self.lease = lease
+        self._lock = Lock()
+        # Автокоммит: транзакции открываются явно там, где нужна атомарность
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL, '
+            'claimed_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB NOT NULL)')
+        logging.info(f'Shared job queue opened: {path}')
+
+    def put(self, job):
+        with self._lock:
+            self._connection.execute('INSERT INTO queue (data) VALUES (?)', (json.dumps(job),))
+
+    def pending_count(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM queue WHERE claimed_until < ?', (time.time(),)).fetchone()[0]
+
+    def claim(self, timeout):
+        """Выдаёт старейшую свободную задачу (или задачу с истёкшей арендой), ожидая до timeout секунд."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                row = self._transaction(self._claim)
+            if row is not None:
+                job_id, data, attempts = row
+                job = json.loads(data)
+                job['queue_id'] = job_id
+                if attempts <= self.MAX_ATTEMPTS:
+                    return job
+                logging.error(f'Job {job["job_id"]} was abandoned by {attempts - 1} worker(s), giving up')
+                self.complete(job, {'job_id': job['job_id'], 'type': 'error', 'error': 'worker crashed'})
+                continue
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def _claim(self):
+        now = time.time()
+        row = self._connection.execute(
+            'SELECT id, data, attempts FROM queue WHERE claimed_until < ? ORDER BY id LIMIT 1', (now,)).fetchone()
+        if row is None:
+            return None
+        self._connection.execute('UPDATE queue SET claimed_until = ?, attempts = attempts + 1 WHERE id = ?',
+                                 (now + self.lease, row[0]))
+        return row[0], row[1], row[2] + 1
+
+    def renew(self, job):
+        with self._lock:
+            self._connection.execute('UPDATE queue SET claimed_until = ? WHERE id = ?',
+                                     (time.time() + self.lease, job['queue_id']))
+
+    def publish(self, result):
+        with self._lock:
+            self._connection.execute('INSERT INTO results (data) VALUES (?)', (json.dumps(result),))
+
+    def complete(self, job, result):
+        def complete():
+            self._connection.execute('DELETE FROM queue WHERE id = ?', (job['queue_id'],))
+            self._connection.execute('INSERT INTO results (data) VALUES (?)', (json.dumps(result),))
+
+        with self._lock:
+            self._transaction(complete)
+
+    def take_results(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                rows = self._transaction(self._take_results)
+            if rows or time.monotonic() >= deadline:
+                return [json.loads(data) for _, data in rows]
+            time.sleep(self.POLL_INTERVAL)
+
+    def _take_results(self):
+        rows = self._connection.execute('SELECT id, data FROM results ORDER BY id LIMIT 100').fetchall()
+        if rows:
+            self._connection.execute('DELETE FROM results WHERE id <= ?', (rows[-1][0],))
+        return rows
+
+    def put_blob(self, digest, path):
+        with self._lock:
+            if self._connection.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone():
+                return
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            self._connection.execute('INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)', (digest, data))
+
+    def fetch_blob(self, digest):
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM blobs WHERE hash = ?', (digest,)).fetchone()
+        return row and row[0]
+
+    def drop_blob(self, digest):
+        with self._lock:
+            self._connection.execute('DELETE FROM blobs WHERE hash = ?', (digest,))
+
+    def _transaction(self, body):
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: два воркера не получат одну задачу
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = body()
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        self._connection.execute('COMMIT')
+        return result
+
+
+class RedisJobQueue:
+    """Общая очередь раздельного режима поверх Redis или совместимого хранилища — для воркеров
+    на разных хостах. Интерфейс тот же, что у SQLiteJobQueue."""
+
+    PREFIX = 'voicebot:'
+    BLOB_TTL = 24 * 3600
+    MAX_ATTEMPTS = SQLiteJobQueue.MAX_ATTEMPTS
+    POLL_INTERVAL = SQLiteJobQueue.POLL_INTERVAL
+    # Перенос задачи в processing, аренда и счётчик попыток — одной атомарной операцией:
+    # воркер, упавший между ними, не оставит в processing задачу без аренды, которую никто не вернёт
+    CLAIM_SCRIPT = """
+local job_id = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+if not job_id then
+    return false
+end
+redis.call('ZADD', KEYS[3], ARGV[1], job_id)
+return {job_id, redis.call('HINCRBY', KEYS[4], job_id, 1)}
+"""
+
+    def __init__(self, url, lease):
+        if redis is None:
+            raise RuntimeError('QUEUE_URL points to Redis, but the redis package is not installed')
+        self.lease = lease
+        self._redis = redis.Redis.from_url(url)
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+        logging.info(f'Shared job queue opened: {url.split("@")[-1]}')
+
+    def _key(self, *parts):
+        return self.PREFIX + ':'.join(str(part) for part in parts)
+
+    def put(self, job):
+        job_id = self._redis.incr(self._key('next_id'))
+        pipeline = self._redis.pipeline()
+        pipeline.set(self._key('job', job_id), json.dumps(job))
+        pipeline.rpush(self._key('pending'), job_id)
+        pipeline.execute()
+
+    def pending_count(self):
+        return self._redis.llen(self._key('pending'))
+
+    def claim(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self._requeue_expired()
+            claimed = self._claim(keys=[self._key('pending'), self._key('processing'), self._key('leases'),
+                                        self._key('attempts')], args=[time.time() + self.lease])
+            if not claimed:
+                # Lua-скрипт не может блокироваться, как BLMOVE, поэтому очередь опрашивается
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            job_id, attempts = int(claimed[0]), int(claimed[1])
+            data = self._redis.get(self._key('job', job_id))
+            if data is None:
+                pipeline = self._redis.pipeline()
+                pipeline.lrem(self._key('processing'), 1, job_id)
+                pipeline.zrem(self._key('leases'), job_id)
+                pipeline.hdel(self._key('attempts'), job_id)
+                pipeline.execute()
+                continue
+            job = json.loads(data)
+            job['queue_id'] = job_id
+            if attempts <= self.MAX_ATTEMPTS:
+                return job
+            logging.error(f'Job {job["job_id"]} was abandoned by {attempts - 1} worker(s), giving up')
+            self.complete(job, {'job_id': job['job_id'], 'type': 'error', 'error': 'worker crashed'})
+
+    def _requeue_expired(self):
+        for job_id in self._redis.zrangebyscore(self._key('leases'), '-inf', time.time()):
+            # ZREM удаётся только одному процессу — он и возвращает задачу в очередь
+            if self._redis.zrem(self._key('leases'), job_id):
+                pipeline = self._redis.pipeline()
+                pipeline.lrem(self._key('processing'), 1, job_id)
+                pipeline.lpush(self._key('pending'), job_id)
+                pipeline.execute()
+
+    def renew(self, job):
+        self._redis.zadd(self._key('leases'), {job['queue_id']: time.time() + self.lease}, xx=True)
+
+    def publish(self, result):
+        self._redis.rpush(self._key('results'), json.dumps(result))
+
+    def complete(self, job, result):
+        job_id = job['queue_id']
+        pipeline = self._redis.pipeline()
+        pipeline.delete(self._key('job', job_id))
+        pipeline.zrem(self._key('leases'), job_id)
+        pipeline.lrem(self._key('processing'), 1, job_id)
+        pipeline.hdel(self._key('attempts'), job_id)
+        pipeline.rpush(self._key('results'), json.dumps(result))
+        pipeline.execute()
+
+    def take_results(self, timeout):
+        item = self._redis.blpop(self._key('results'), timeout=max(1, int(timeout)))
+        if item is None:
+            return []
+        rest = self._redis.lpop(self._key('results'), 99) or []
+        return [json.loads(data) for data in [item[1], *rest]]
+
+    def put_blob(self, digest, path):
+        if self._redis.exists(self._key('blob', digest)):
+            return
+        with open(path, 'rb') as f:
+            self._redis.set(self._key('blob', digest), f.read(), ex=self.BLOB_TTL, nx=True)
+
+    def fetch_blob(self, digest):
+        return self._redis.get(self._key('blob', digest))
+
+    def drop_blob(self, digest):
+        self._redis.delete(self._key('blob', digest))
+
+
+def open_job_queue(url, lease):
+    """Открывает общую очередь по адресу: redis://..., rediss://... или sqlite:///путь (либо просто путь)."""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisJobQueue(url, lease)
+    return SQLiteJobQueue(url[len('sqlite:///'):] if url.startswith('sqlite:///') else url, lease)
+
+
+class MicroBatcher:
+    """Собирает короткие задачи из очереди в пакет для одного пакетного прохода модели.
+
+    Пакетный проход распознаёт записи иначе, чем обычный: BatchedInferencePipeline с
+    clip_timestamps не применяет VAD (тишина и шум внутри записи попадают в модель),
+    не передаёт контекст предыдущего текста (condition_on_previous_text=False) и не
+    повторяет декодирование с другими температурами. Поэтому пакеты включаются только
+    явно, через MICRO_BATCH_SIZE > 1.
+    """
+
+    # Окно модели Whisper: каждая запись пакета должна в него помещаться
+    MAX_CLIP_SECONDS = 30
+
+    def __init__(self, max_batch_size, max_wait, max_duration, metrics=None):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_duration = min(max_duration, self.MAX_CLIP_SECONDS)
+        self.metrics = metrics
+        self.batches = 0
+        self.batched_jobs = 0
+        self.total_wait = 0.0
+        self._lock = Lock()
+
+    def accepts(self, job):
+        duration = job.get('duration')
+        return self.max_batch_size > 1 and duration is not None and duration <= self.max_duration
+
+    def collect(self, chat_manager, first, compatible=None):
+        """Добирает к first подходящие задачи; compatible(job) дополнительно ограничивает выбор."""
+        started = time.monotonic()
+        predicate = self.accepts if compatible is None else lambda job: self.accepts(job) and compatible(job)
+        batch = chat_manager.take_batch(first, predicate, self.max_batch_size, self.max_wait)
+        wait = time.monotonic() - started
+        if self.metrics is not None:
+            self.metrics.observe_batch(len(batch), self.max_batch_size, wait)
+        if len(batch) > 1:
+            with self._lock:
+                self.batches += 1
+                self.batched_jobs += len(batch)
+                self.total_wait += wait
+        return batch
+
+    def transcribe(self, model, audios, **options):
+        """Склеивает записи и распознаёт их одним вызовом; возвращает тексты в порядке audios."""
+        clips = []
+        offset = 0
+        for audio in audios:
+            clips.append({'start': offset / SAMPLE_RATE, 'end': (offset + len(audio)) / SAMPLE_RATE})
+            offset += len(audio)
+        pipeline = BatchedInferencePipeline(model=model)
+        segments, info = pipeline.transcribe(np.concatenate(audios), clip_timestamps=clips,
+                                             batch_size=len(audios), **options)
+        # Таймкоды сегментов отсчитываются от начала склейки — по ним находим исходную запись
+        starts = [clip['start'] for clip in clips]
+        texts = [[] for _ in audios]
+        for segment in segments:
+            index = max(0, bisect.bisect_right(starts, segment.start + 1e-3) - 1)
+            texts[index].append(segment.text)
+        return [" ".join(parts) for parts in texts]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'batched_jobs': self.batched_jobs,
+                'average_size': self.batched_jobs / self.batches if self.batches else 0.0,
+                'average_wait': self.total_wait / self.batches if self.batches else 0.0,
+            }
+
+
+class TranscriptExport:
+    """Файл расшифровки с таймкодами, который пишется по мере поступления сегментов.
+
+    Сегменты не копятся в памяти: каждый сразу сериализуется в буфер, из которого
+    файл и отправляется в Telegram. txt — обычная расшифровка сообщением или файлом
+    .txt, для неё экспорт не создаётся.
+    """
+
+    FORMATS = {
+        'txt': 'текст сообщением или файлом .txt (по умолчанию)',
+        'srt': 'субтитры SRT',
+        'vtt': 'субтитры WebVTT',
+        'json': 'JSON с таймкодами сегментов',
+        'json_words': 'JSON с таймкодами сегментов и отдельных слов',
+    }
+    EXTENSIONS = {'srt': '.srt', 'vtt': '.vtt', 'json': '.json', 'json_words': '.json'}
+
+    def __init__(self, export_format):
+        self.format = export_format
+        self.extension = self.EXTENSIONS[export_format]
+        self.buffer = io.BytesIO()
+        self.count = 0
+        if export_format == 'vtt':
+            self._write("WEBVTT\n\n")
+        elif export_format in ('json', 'json_words'):
+            self._write('{"segments": [')
+
+    @staticmethod
+    def word_timestamps(export_format):
+        return export_format == 'json_words'
+
+    def add(self, start, end, text, words=None):
+        text = text.strip()
+        if not text:
+            return
+        self.count += 1
+        if self.format == 'srt':
+            self._write(f"{self.count}\n{format_timestamp(start, ',')} --> {format_timestamp(end, ',')}\n{text}\n\n")
+        elif self.format == 'vtt':
+            # В WebVTT текст реплики — разметка: & и < нужно экранировать
+            text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            self._write(f"{format_timestamp(start, '.')} --> {format_timestamp(end, '.')}\n{text}\n\n")
+        else:
+            item = {'start': round(start, 3), 'end': round(end, 3), 'text': text}
+            if words is not None:
+                item['words'] = [{'start': round(word_start, 3), 'end': round(word_end, 3), 'word': word.strip()}
+                                 for word_start, word_end, word in words]
+            self._write((", " if self.count > 1 else "") + json.dumps(item, ensure_ascii=False))
+
+    def finish(self):
+        """Завершает файл и возвращает буфер, готовый к отправке."""
+        if self.format in ('json', 'json_words'):
+            self._write("]}\n")
+        self.buffer.seek(0)
+        return self.buffer
+
+    def _write(self, text):
+        self.buffer.write(text.encode('utf-8'))
+
+
+class UserSettings:
+    """Настройки пользователей (формат расшифровки) в SQLite."""
+
+    def __init__(self, path):
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS settings ('
+                'user_id INTEGER NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (user_id, name))'
+            )
+        self._values = {}
+
+    def get(self, user_id, name, default=None):
+        key = (user_id, name)
+        with self._lock:
+            if key not in self._values:
+                row = self._connection.execute(
+                    'SELECT value FROM settings WHERE user_id = ? AND name = ?', (user_id, name)).fetchone()
+                self._values[key] = row[0] if row else None
+            value = self._values[key]
+        return default if value is None else value
+
+    def set(self, user_id, name, value):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO settings (user_id, name, value) VALUES (?, ?, ?)',
+                                     (user_id, name, value))
+            self._values[(user_id, name)] = value
+
+
+class DeliveryPlanner:
+    """Разбивает расшифровку на сообщения Telegram и решает, не отправить ли её файлом.
+
+    Текст режется по лучшей границе в последней части сообщения: паузе между сегментами
+    (по таймкодам, если они есть), границе сегмента, концу предложения или, в крайнем случае,
+    пробелу. Длина считается так же, как Telegram считает лимит: по видимому тексту
+    после разбора HTML в единицах UTF-16, а в разметку части попадают экранированными.
+    Каждое слово просматривается константное число раз, поэтому время линейно от длины текста.
+    """
+
+    WORD, SENTENCE, SEGMENT, PAUSE = range(4)
+    SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+    def __init__(self, limit=TELEGRAM_TEXT_LIMIT, min_fill=0.5, pause=1.0):
+        self.limit = limit
+        # Раньше этой доли лимита сообщение не обрывается даже ради лучшей границы
+        self.min_fill = min_fill
+        self.pause = pause
+
+    def plan(self, text, segments=None, max_messages=1, reserve=0):
+        """HTML-части для отправки сообщениями или None, если их больше max_messages.
+
+        reserve — сколько видимых символов занимает приписка к первому сообщению;
+        остальные части используют лимит целиком.
+        """
+        # Заведомо не помещающийся текст не разбираем
+        if utf16_length(text) > 2 * self.limit * max_messages:
+            return None
+        chunks = self.split(text, segments, self.limit, first_limit=self.limit - reserve)
+        if len(chunks) > max_messages:
+            return None
+        return [f"<blockquote expandable>{escape_html(chunk)}</blockquote>" for chunk in chunks]
+
+    def split(self, text, segments=None, limit=None, first_limit=None):
+        """Делит текст на части не длиннее limit единиц UTF-16 (первую — не длиннее first_limit);
+        возвращает неэкранированный текст."""
+        limit = limit or self.limit
+        first_limit = min(first_limit or limit, limit)
+        chunks = []
+        pieces = []
+        # ends[i] — длина первых i + 1 частей через пробел
+        ends = []
+        for piece, size, rank in self.pieces(text, segments, first_limit):
+            while pieces and ends[-1] + 1 + size > (limit if chunks else first_limit):
+                cut = self._best_cut(pieces, ends, limit if chunks else first_limit)
+                chunks.append(" ".join(piece_text for piece_text, _ in pieces[:cut]))
+                pieces = pieces[cut:]
+                shift = ends[cut - 1] + 1
+                ends = [end - shift for end in ends[cut:]]
+            ends.append(ends[-1] + 1 + size if pieces else size)
+            pieces.append((piece, rank))
+        if pieces:
+            chunks.append(" ".join(piece_text for piece_text, _ in pieces))
+        return chunks
+
+    def pieces(self, text, segments, limit):
+        """Части текста (текст, длина, ранг границы после неё): предложения или слова длинных предложений."""
+        if not segments:
+            yield from self._sentences(text, self.SENTENCE, limit)
+            return
+        for index, (_, end, segment_text) in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1][0] - end >= self.pause:
+                rank = self.PAUSE
+            else:
+                rank = self.SEGMENT
+            yield from self._sentences(segment_text, rank, limit)
+
+    def _sentences(self, text, last_rank, limit):
+        sentences = [" ".join(sentence.split()) for sentence in self.SENTENCE_END.split(text.strip())]
+        sentences = [sentence for sentence in sentences if sentence]
+        for index, sentence in enumerate(sentences):
+            rank = last_rank if index == len(sentences) - 1 else self.SENTENCE
+            size = utf16_length(sentence)
+            if size <= limit:
+                yield sentence, size, rank
+                continue
+            words = sentence.split(" ")
+            for word_index, word in enumerate(words):
+                word_rank = rank if word_index == len(words) - 1 else self.WORD
+                # Слово длиннее сообщения режем по символам
+                while utf16_length(word) > limit:
+                    yield word[:limit // 2], utf16_length(word[:limit // 2]), self.WORD
+                    word = word[limit // 2:]
+                yield word, utf16_length(word), word_rank
+
+    def _best_cut(self, pieces, ends, limit):
+        """Сколько частей уйдёт в сообщение: после самой сильной границы дальше min_fill."""
+        best = len(pieces)
+        best_rank = -1
+        floor = limit * self.min_fill
+        for index in range(len(pieces) - 1, -1, -1):
+            if ends[index] < floor:
+                break
+            if pieces[index][1] > best_rank:
+                best, best_rank = index + 1, pieces[index][1]
+        return best
+
+
+class LanguageProfiles:
+    """Профили языков по чатам для режима автоопределения.
+
+    Для каждого чата копятся вероятности, с которыми Whisper определял язык (старые
+    наблюдения затухают). Уверенность — доля лидирующего языка с априорной поправкой,
+    поэтому одного определения мало: нужно два-три согласных. Пока профиль не уверен,
+    язык определяется по первым 30 секундам каждой записи; потом используется язык
+    профиля, а определение повторяется раз в recheck_every записей.
+    """
+
+    PRIOR = 0.5
+    DECAY = 0.9
+    MAX_CHATS = 10000
+
+    def __init__(self, threshold, recheck_every):
+        self.threshold = threshold
+        self.recheck_every = recheck_every
+        self._profiles = OrderedDict()
+        self._lock = Lock()
+
+    def choose(self, chat_id):
+        """Язык для очередной записи чата или None, если его нужно определить."""
+        with self._lock:
+            profile = self._profiles.get(chat_id)
+            if profile is None:
+                return None
+            language, confidence = self._top(profile)
+            if confidence < self.threshold:
+                return None
+            profile['skipped'] += 1
+            if self.recheck_every and profile['skipped'] > self.recheck_every:
+                return None
+            return language
+
+    def peek(self, chat_id):
+        """Язык уверенного профиля или None; в отличие от choose, не считает запись."""
+        with self._lock:
+            profile = self._profiles.get(chat_id)
+            if profile is None:
+                return None
+            language, confidence = self._top(profile)
+            return language if confidence >= self.threshold else None
+
+    def observe(self, chat_id, language, probability):
+        with self._lock:
+            profile = self._profiles.pop(chat_id, None) or {'scores': {}, 'detections': 0, 'skipped': 0}
+            was_confident = profile['scores'] and self._top(profile)[1] >= self.threshold
+            scores = profile['scores']
+            for key in scores:
+                scores[key] *= self.DECAY
+            scores[language] = scores.get(language, 0.0) + probability
+            profile['detections'] += 1
+            profile['skipped'] = 0
+            self._profiles[chat_id] = profile
+            if len(self._profiles) > self.MAX_CHATS:
+                self._profiles.popitem(last=False)
+            top, confidence = self._top(profile)
+        if confidence >= self.threshold and not was_confident:
+            logging.info(f'Chat {chat_id} language profile is confident: {top} ({confidence:.2f})')
+
+    def describe(self, chat_id):
+        with self._lock:
+            profile = self._profiles.get(chat_id)
+            if profile is None:
+                return None
+            language, confidence = self._top(profile)
+            return language, confidence, profile['detections']
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def _top(self, profile):
+        scores = profile['scores']
+        language = max(scores, key=scores.get)
+        return language, scores[language] / (sum(scores.values()) + self.PRIOR)
+
+
+class LoadController:
+    """Управляет качеством распознавания по оценке отставания очереди.
+
+    Отставание — сколько секунд займёт разбор текущей очереди: суммарная длительность
+    ожидающих записей, умноженная на скользящее среднее RTF, плюс накладные расходы на задачу.
+    С ростом отставания качество ступенчато снижается (жадный поиск, затем запасная модель),
+    после жёсткого порога длинные файлы не принимаются. Обратно уровень понижается по одной
+    ступени, когда отставание падает ниже recovery_ratio от порога ступени.
+    """
+
+    LEVELS = ('full', 'greedy', 'fallback')
+    JOB_OVERHEAD = 1.0
+    RTF_SMOOTHING = 0.2
+
+    def __init__(self, chat_manager, greedy_backlog, fallback_backlog, reject_backlog,
+                 has_fallback_model, recovery_ratio=0.5, initial_rtf=0.2):
+        self.chat_manager = chat_manager
+        self.thresholds = [greedy_backlog]
+        if has_fallback_model:
+            self.thresholds.append(fallback_backlog)
+        self.reject_backlog = reject_backlog
+        self.recovery_ratio = recovery_ratio
+        self.rtf = initial_rtf
+        self.level = 0
+        self._lock = Lock()
+
+    def backlog_seconds(self):
+        manager = self.chat_manager
+        return manager.queued_seconds * self.rtf + manager.state_counts['queued'] * self.JOB_OVERHEAD
+
+    def update(self):
+        """Пересчитывает уровень деградации и возвращает его."""
+        backlog = self.backlog_seconds()
+        with self._lock:
+            target = sum(1 for threshold in self.thresholds if threshold and backlog >= threshold)
+            level = self.level
+            if target > level:
+                level = target
+            elif target < level and backlog < self.thresholds[level - 1] * self.recovery_ratio:
+                level -= 1
+            if level != self.level:
+                logging.warning(f'Load level changed: {self.LEVELS[self.level]} -> {self.LEVELS[level]} '
+                                f'(backlog {backlog:.0f} s, queue depth {self.chat_manager.state_counts["queued"]}, '
+                                f'rtf {self.rtf:.2f})')
+                self.level = level
+            return level
+
+    def should_reject(self):
+        return bool(self.reject_backlog) and self.backlog_seconds() >= self.reject_backlog
+
+    def observe(self, audio_seconds, processing_seconds):
+        """Учитывает фактический RTF завершённой задачи."""
+        if audio_seconds <= 0:
+            return
+        with self._lock:
+            self.rtf += self.RTF_SMOOTHING * (processing_seconds / audio_seconds - self.rtf)
+
+
+class EtaEstimator:
+    """Оценка времени начала и окончания задач в очереди.
+
+    Для каждой пары (тип медиа, модель) ведётся скользящее среднее RTF; время задачи —
+    длительность из Telegram × RTF плюс накладные расходы. Пока по паре нет наблюдений,
+    берётся общий RTF из default_rtf(). Очередь проигрывается в порядке планировщика
+    на workers воркерах с учётом уже распознаваемых задач.
+    """
+
+    SMOOTHING = 0.2
+
+    def __init__(self, workers, default_rtf):
+        self.workers = workers
+        self.default_rtf = default_rtf
+        self._rtf = {}
+        self._lock = Lock()
+
+    def observe(self, job, model, audio_seconds, processing_seconds):
+        if audio_seconds <= 0:
+            return
+        key = (media_label(job), model)
+        sample = processing_seconds / audio_seconds
+        with self._lock:
+            current = self._rtf.get(key)
+            self._rtf[key] = sample if current is None else current + self.SMOOTHING * (sample - current)
+
+    def rtf(self, job, model):
+        with self._lock:
+            rtf = self._rtf.get((media_label(job), model))
+        return self.default_rtf() if rtf is None else rtf
+
+    def job_seconds(self, job, model):
+        return estimated_duration(job) * self.rtf(job, model) + LoadController.JOB_OVERHEAD
+
+    def estimate(self, queued, running, model, now):
+        """Для каждой ожидающей задачи: (задача, позиция, секунд до начала, секунд до окончания)."""
+        # Моменты освобождения воркеров: уже идущие задачи досчитываются, остальные воркеры свободны
+        free_at = sorted(max(0.0, self.job_seconds(job, model) - (now - (job.get('started_at') or now)))
+                         for job in running)[:self.workers]
+        free_at += [0.0] * (self.workers - len(free_at))
+        heapq.heapify(free_at)
+        estimates = []
+        for position, job in enumerate(queued, start=1):
+            start = heapq.heappop(free_at)
+            finish = start + self.job_seconds(job, model)
+            heapq.heappush(free_at, finish)
+            estimates.append((job, position, start, finish))
+        return estimates
+
+
+class TranscriptionCache:
+    """Постоянный кэш расшифровок на SQLite с вытеснением по возрасту и суммарному размеру."""
+
+    def __init__(self, path, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS transcriptions ('
+                'key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created REAL NOT NULL, last_used REAL NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS transcriptions_last_used ON transcriptions (last_used)')
+        self._total_bytes = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM transcriptions').fetchone()[0]
+        logging.info(f'Transcription cache opened: {path}, {self._total_bytes} bytes')
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT text, created FROM transcriptions WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE transcriptions SET last_used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, text):
+        now = time.time()
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT size FROM transcriptions WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._total_bytes -= row[0]
+            self._connection.execute(
+                'INSERT OR REPLACE INTO transcriptions (key, text, size, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?)', (key, text, size, now, now))
+            self._total_bytes += size
+            self._evict(now)
+
+    def _evict(self, now):
+        expired = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM transcriptions WHERE created < ?',
+            (now - self.max_age,)).fetchone()
+        if expired[1]:
+            self._connection.execute('DELETE FROM transcriptions WHERE created < ?', (now - self.max_age,))
+            self._total_bytes -= expired[0]
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Вытесняем давно не использованные записи, пока не уложимся в лимит
+        excess = self._total_bytes - self.max_bytes
+        victims = []
+        for key, size in self._connection.execute(
+                'SELECT key, size FROM transcriptions ORDER BY last_used'):
+            victims.append((key,))
+            excess -= size
+            self._total_bytes -= size
+            if excess <= 0:
+                break
+        self._connection.executemany('DELETE FROM transcriptions WHERE key = ?', victims)
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute('SELECT COUNT(*) FROM transcriptions').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self._total_bytes}
+
+
+class AudioIndex:
+    """Индекс акустических отпечатков уже распознанных записей на SQLite.
+
+    Находит ту же запись, пришедшую с другим file_unique_id (голосовое, пересжатое видео,
+    документ): кандидаты отбираются по длительности, затем сравнивается доля различающихся
+    бит отпечатков с небольшим сдвигом — перекодирование может добавить задержку в начале.
+    Отпечатки держатся в памяти, расшифровки читаются из базы только при совпадении.
+    """
+
+    DURATION_TOLERANCE = 1.0  # Допуск по длительности, с (или 2 % длины записи)
+    MAX_SHIFT = 3  # Допустимый сдвиг начала, кадров
+
+    def __init__(self, path, threshold, seconds, max_entries):
+        self.threshold = threshold
+        self.seconds = seconds
+        self.max_entries = max_entries
+        self.lookups = 0
+        self.hits = 0
+        self.saved_seconds = 0.0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, variant TEXT NOT NULL, duration REAL NOT NULL, '
+                'fingerprint BLOB NOT NULL, silence BLOB NOT NULL, text TEXT NOT NULL)'
+            )
+        # id -> (вариант распознавания, длительность, отпечаток)
+        self._entries = OrderedDict(
+            (entry_id, (variant, duration, self._unpack(fingerprint, silence)))
+            for entry_id, variant, duration, fingerprint, silence in self._connection.execute(
+                'SELECT id, variant, duration, fingerprint, silence FROM fingerprints ORDER BY id'))
+        logging.info(f'Audio fingerprint index opened: {path}, {len(self._entries)} entries')
+
+    def lookup(self, fingerprint, duration, variant):
+        """Расшифровка ближайшей записи с тем же variant, если она ближе порога, иначе None."""
+        tolerance = max(self.DURATION_TOLERANCE, duration * 0.02)
+        with self._lock:
+            self.lookups += 1
+            best_id, best_distance = None, self.threshold
+            for entry_id, (entry_variant, entry_duration, entry) in self._entries.items():
+                if entry_variant != variant or abs(entry_duration - duration) > tolerance:
+                    continue
+                distance = self.distance(fingerprint, entry)
+                if distance <= best_distance:
+                    best_id, best_distance = entry_id, distance
+            if best_id is None:
+                return None
+            row = self._connection.execute('SELECT text FROM fingerprints WHERE id = ?', (best_id,)).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            return row[0]
+
+    def add(self, fingerprint, duration, variant, text):
+        codes, quiet = fingerprint
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO fingerprints (variant, duration, fingerprint, silence, text) VALUES (?, ?, ?, ?, ?)',
+                (variant, duration, codes.tobytes(), np.packbits(quiet).tobytes(), text))
+            self._entries[cursor.lastrowid] = (variant, duration, fingerprint)
+            # Вытесняем самые старые записи
+            victims = []
+            while len(self._entries) > self.max_entries:
+                victims.append((self._entries.popitem(last=False)[0],))
+            self._connection.executemany('DELETE FROM fingerprints WHERE id = ?', victims)
+
+    def record_saving(self, model_seconds):
+        with self._lock:
+            self.saved_seconds += model_seconds
+
+    @staticmethod
+    def _unpack(codes, silence):
+        codes = np.frombuffer(codes, dtype='<u4')
+        return codes, np.unpackbits(np.frombuffer(silence, dtype=np.uint8), count=len(codes)).astype(bool)
+
+    @classmethod
+    def distance(cls, a, b):
+        """Минимальная по сдвигам доля различающихся бит на общем участке отпечатков.
+
+        Кадры, тихие в обеих записях, пропускаются; тишина только в одной из них
+        считается как половина различающихся бит, то есть как несовпадение наугад.
+        """
+        best = 1.0
+        for shift in range(-cls.MAX_SHIFT, cls.MAX_SHIFT + 1):
+            start_a, start_b = max(shift, 0), max(-shift, 0)
+            length = min(len(a[0]) - start_a, len(b[0]) - start_b)
+            if length < FINGERPRINT_MIN_FRAMES:
+                continue
+            codes_a, quiet_a = a[0][start_a:start_a + length], a[1][start_a:start_a + length]
+            codes_b, quiet_b = b[0][start_b:start_b + length], b[1][start_b:start_b + length]
+            voiced = ~(quiet_a | quiet_b)
+            compared = int(voiced.sum())
+            if compared < FINGERPRINT_MIN_FRAMES:
+                continue
+            mismatched = int((quiet_a ^ quiet_b).sum())
+            differing = POPCOUNT[np.bitwise_xor(codes_a[voiced], codes_b[voiced]).view(np.uint8)].sum(dtype=np.int64)
+            best = min(best, (differing + 16 * mismatched) / (32 * (compared + mismatched)))
+        return best
+
+    def stats(self):
+        with self._lock:
+            return {'lookups': self.lookups, 'hits': self.hits, 'saved_seconds': self.saved_seconds,
+                    'entries': len(self._entries)}
+
+
+class FileTooLargeError(Exception):
+    pass
+
+
+class DownloadManager:
+    """Пул загрузок: потоково скачивает файлы Telegram на диск вне потоков обработчиков."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, api_token, max_workers, max_file_size):
+        self.api_token = api_token
+        self.max_file_size = max_file_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        # Общая сессия переиспользует TCP/TLS-соединения между загрузками
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if telebot.apihelper.proxy:
+            self.session.proxies.update(telebot.apihelper.proxy)
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def file_url(self, file_path):
+        if telebot.apihelper.FILE_URL is None:
+            return f"https://api.telegram.org/file/bot{self.api_token}/{file_path}"
+        return telebot.apihelper.FILE_URL.format(self.api_token, file_path)
+
+    def download(self, file_path, destination):
+        """Скачивает файл частями во временный файл и атомарно переименовывает его."""
+        partial_path = destination + '.part'
+        received = 0
+        try:
+            with self.session.get(self.file_url(file_path), stream=True, timeout=(10, 60)) as response:
+                response.raise_for_status()
+                declared = int(response.headers.get('Content-Length') or 0)
+                if declared > self.max_file_size:
+                    raise FileTooLargeError(f'{declared} bytes declared by the server')
+                with open(partial_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                        received += len(chunk)
+                        if received > self.max_file_size:
+                            raise FileTooLargeError(f'more than {self.max_file_size} bytes received')
+                        f.write(chunk)
+            os.replace(partial_path, destination)
+        except BaseException:
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+            raise
+        return received
+
+
+class MemoryBudget:
+    """Учёт байтов в обработке: скачанные файлы в каталоге временных файлов и декодированный PCM.
+
+    Пока учтённый объём больше limit, новые загрузки ждут освобождения (задачи при этом
+    уже записаны в журнал вместе с file_id и после перезапуска скачиваются заново).
+    Декодирование не ждёт — иначе воркеры и загрузки могли бы блокировать друг друга, —
+    поэтому пик ограничен limit плюс PCM распознаваемых задач.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.waits = 0
+        self._condition = Condition()
+
+    def reserve(self, size):
+        """Блокируется, пока size не помещается в бюджет. Одиночный файл больше limit проходит,
+        когда в обработке ничего нет."""
+        with self._condition:
+            if self.limit and self.in_flight and self.in_flight + size > self.limit:
+                self.waits += 1
+                logging.warning(f'Memory budget exhausted ({self.in_flight} of {self.limit} bytes in flight), '
+                                f'intake paused')
+                self._condition.wait_for(lambda: not self.in_flight or self.in_flight + size <= self.limit)
+            self._add(size)
+
+    def charge(self, size):
+        with self._condition:
+            self._add(size)
+
+    def release(self, size):
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+    def _add(self, size):
+        self.in_flight += size
+        self.peak = max(self.peak, self.in_flight)
+
+
+class TTLCache:
+    """Кэш результатов редких вызовов API: значение перезапрашивается после ttl секунд
+    или после явного сброса."""
+
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key, load):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Загрузка идёт без блокировки: параллельный промах лишь повторит запрос
+        value = load()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now, tokens=1):
+        """Сколько секунд ждать, пока накопится tokens свободных токенов."""
+        self._refill(now)
+        return 0.0 if self.tokens >= tokens else (tokens - self.tokens) / self.rate
+
+    def reserve(self, now):
+        """Забирает токен (допуская долг) и возвращает время ожидания до его появления."""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def block(self, now, seconds):
+        """Следующий токен появится не раньше чем через seconds секунд (ответ 429 с retry_after)."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class JobProfiler:
+    """Режим профилирования: трасса этапов каждой задачи и выборочный cProfile.
+
+    Этапы (скачивание, ожидание в очереди, декодирование, распознавание, вызовы Bot API...)
+    записываются как события Chrome trace и по завершении задачи сохраняются в
+    <directory>/job-<id>-<pid>.json — файл открывается в chrome://tracing или Perfetto.
+    Первые sample_jobs задач дополнительно профилируются cProfile (job-<id>-<pid>.prof,
+    читается pstats или snakeviz). Выключенный профилировщик почти ничего не стоит.
+    """
+
+    def __init__(self, enabled, directory, sample_jobs=0):
+        self.enabled = enabled
+        self.directory = directory
+        self.sample_jobs = sample_jobs if enabled else 0
+        self.sampled = 0
+        self._traces = {}
+        self._lock = Lock()
+        # cProfile профилирует один поток, а два активных профилировщика Python не допускает
+        self._sampling = Lock()
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            logging.info(f'Profiling mode: traces in {directory}, cProfile for {self.sample_jobs} job(s)')
+
+    @staticmethod
+    def activate(job_id):
+        """Помечает текущий поток как обрабатывающий задачу job_id (для лога и трассы)."""
+        return _JobContext(job_id)
+
+    def span(self, name, **args):
+        """Контекстный менеджер: этап текущей задачи."""
+        if not self.enabled or current_job_id() is None:
+            return _NULL_SPAN
+        return _Span(self, current_job_id(), name, args)
+
+    def add_span(self, job_id, name, start, end, **args):
+        """Этап с известными границами (time.time()), например ожидание в очереди."""
+        if not self.enabled or job_id is None:
+            return
+        event = {'name': name, 'cat': 'voicebot', 'ph': 'X', 'ts': int(start * 1e6),
+                 'dur': max(0, int((end - start) * 1e6)), 'pid': os.getpid(), 'tid': get_ident()}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._traces.setdefault(job_id, []).append(event)
+
+    def sample(self, job_id):
+        """Контекстный менеджер: cProfile для первых sample_jobs задач."""
+        if self.sampled >= self.sample_jobs or not self._sampling.acquire(blocking=False):
+            return _NULL_SPAN
+        with self._lock:
+            if self.sampled >= self.sample_jobs:
+                self._sampling.release()
+                return _NULL_SPAN
+            self.sampled += 1
+        return _Sample(self, job_id)
+
+    def finish(self, job_id):
+        """Сохраняет трассу завершённой задачи."""
+        if not self.enabled:
+            return
+        with self._lock:
+            events = self._traces.pop(job_id, None)
+        if not events:
+            return
+        threads = {event['tid'] for event in events}
+        names = {thread.ident: thread.name for thread in threading_enumerate() if thread.ident in threads}
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                     'args': {'name': names.get(tid, str(tid))}} for tid in threads]
+        path = os.path.join(self.directory, f'job-{job_id}-{os.getpid()}.json')
+        try:
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+        except OSError as e:
+            logging.error(f'Failed to write trace {path}: {e}')
+
+
+class _JobContext:
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def __enter__(self):
+        self.previous = current_job_id()
+        set_current_job(self.job_id)
+
+    def __exit__(self, *exc):
+        set_current_job(self.previous)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, profiler, job_id, name, args):
+        self.profiler = profiler
+        self.job_id = job_id
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.profiler.add_span(self.job_id, self.name, self.start, time.time(), **self.args)
+
+
+class _Sample:
+    def __init__(self, profiler, job_id):
+        self.profiler = profiler
+        self.job_id = job_id
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        try:
+            self.profile.enable()
+        except ValueError:
+            # Профилировщик уже включён извне (например, python -m cProfile)
+            self.profile = None
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self.profile is None:
+                return
+            self.profile.disable()
+            path = os.path.join(self.profiler.directory, f'job-{self.job_id}-{os.getpid()}.prof')
+            self.profile.dump_stats(path)
+            logging.info(f'cProfile stats written to {path}')
+        except OSError as e:
+            logging.error(f'Failed to write profile: {e}')
+        finally:
+            self.profiler._sampling.release()
+
+
+class Metrics:
+    """Метрики Prometheus: длительности этапов по типам медиа и вызовы Bot API по методам.
+
+    Глубина очереди не хранится отдельно, а считается из ChatManager в момент опроса.
+    """
+
+    STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    RTF_BUCKETS = (0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5)
+    API_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+    BATCH_SIZE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+    BATCH_FILL_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1)
+    BATCH_WAIT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.5, 1, 2)
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        ProcessCollector(registry=self.registry)
+        self._chat_manager = None
+        self._health = None
+        self._memory = None
+        self.registry.register(self)
+
+        def stage(name, documentation):
+            return Histogram(name, documentation, ['media_type'], buckets=self.STAGE_BUCKETS,
+                             registry=self.registry)
+
+        self.wait_seconds = stage('voicebot_queue_wait_seconds', 'Time a job spent queued before transcription')
+        self.download_seconds = stage('voicebot_download_seconds', 'Time to download the source file')
+        self.decode_seconds = stage('voicebot_decode_seconds', 'Time to decode media to 16 kHz mono PCM')
+        self.transcription_seconds = stage('voicebot_transcription_seconds', 'Model transcription time')
+        self.realtime_factor = Histogram('voicebot_realtime_factor',
+                                         'Transcription time divided by audio duration',
+                                         ['media_type'], buckets=self.RTF_BUCKETS, registry=self.registry)
+        self.api_seconds = Histogram('voicebot_telegram_api_seconds', 'Bot API call latency',
+                                     ['method'], buckets=self.API_BUCKETS, registry=self.registry)
+        self.api_errors = MetricCounter('voicebot_telegram_api_errors', 'Failed Bot API calls',
+                                        ['method', 'code'], registry=self.registry)
+        self.api_too_many_requests = MetricCounter('voicebot_telegram_api_too_many_requests',
+                                                   'Bot API calls answered with 429', ['method'],
+                                                   registry=self.registry)
+        self.duplicates = MetricCounter('voicebot_dedup_hits', 'Jobs answered from the audio fingerprint index',
+                                        ['media_type'], registry=self.registry)
+        self.dedup_saved_seconds = MetricCounter('voicebot_dedup_saved_model_seconds',
+                                                 'Estimated model time saved by fingerprint dedup',
+                                                 ['media_type'], registry=self.registry)
+        self.batch_size = Histogram('voicebot_micro_batch_jobs', 'Jobs collected into one micro-batch',
+                                    buckets=self.BATCH_SIZE_BUCKETS, registry=self.registry)
+        self.batch_fill = Histogram('voicebot_micro_batch_fill_ratio',
+                                    'Micro-batch size divided by MICRO_BATCH_SIZE',
+                                    buckets=self.BATCH_FILL_BUCKETS, registry=self.registry)
+        self.batch_wait_seconds = Histogram('voicebot_micro_batch_wait_seconds',
+                                            'Time a worker waited to fill a micro-batch',
+                                            buckets=self.BATCH_WAIT_BUCKETS, registry=self.registry)
+
+    def track_queue(self, chat_manager):
+        self._chat_manager = chat_manager
+
+    def track_health(self, health):
+        self._health = health
+
+    def track_memory(self, memory):
+        self._memory = memory
+
+    def collect(self):
+        depth = GaugeMetricFamily('voicebot_jobs', 'Jobs by state and media type',
+                                  labels=['state', 'media_type'])
+        if self._chat_manager is not None:
+            for (state, media_type), count in self._chat_manager.depth_by_media().items():
+                depth.add_metric([state, media_type], count)
+        yield depth
+        if self._health is not None:
+            yield GaugeMetricFamily('voicebot_ready', 'Whether models are loaded and warmed up',
+                                    value=int(self._health()['ready']))
+        if self._memory is not None:
+            yield GaugeMetricFamily('voicebot_memory_in_flight_bytes',
+                                    'Downloaded files and decoded audio currently held', value=self._memory.in_flight)
+            yield GaugeMetricFamily('voicebot_memory_budget_bytes', 'Configured in-flight memory budget',
+                                    value=self._memory.limit)
+        yield GaugeMetricFamily('voicebot_peak_rss_bytes', 'Peak resident set size of the process',
+                                value=peak_rss_bytes())
+
+    def describe(self):
+        # Без describe() реестр вызвал бы collect() прямо при регистрации
+        return []
+
+    def observe_transcription(self, job, seconds, audio_seconds):
+        label = media_label(job)
+        self.transcription_seconds.labels(label).observe(seconds)
+        if audio_seconds > 0:
+            self.realtime_factor.labels(label).observe(seconds / audio_seconds)
+
+    def observe_batch(self, size, max_size, wait):
+        self.batch_size.observe(size)
+        self.batch_fill.observe(size / max_size)
+        self.batch_wait_seconds.observe(wait)
+
+    def observe_duplicate(self, job, saved_seconds):
+        label = media_label(job)
+        self.duplicates.labels(label).inc()
+        self.dedup_saved_seconds.labels(label).inc(saved_seconds)
+
+    def serve(self, host, port):
+        """Поднимает служебный HTTP-сервер: /metrics для Prometheus и /health для проверок готовности.
+
+        /health отвечает 503, пока модели загружаются, чтобы оркестратор не считал бота готовым.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                if path == '/metrics':
+                    return self._respond(200, generate_latest(metrics.registry), CONTENT_TYPE_LATEST)
+                if path == '/health' and metrics._health is not None:
+                    health = metrics._health()
+                    return self._respond(200 if health['ready'] else 503, json.dumps(health).encode(),
+                                         'application/json')
+                self._respond(404, b'', 'text/plain')
+
+            def _respond(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        Thread(target=httpd.serve_forever, daemon=True, name='metrics-server').start()
+        logging.info(f'Metrics and health check available at http://{host}:{port}/metrics, /health')
+
+
+class TelegramDispatcher:
+    """Единая точка исходящих вызовов Bot API.
+
+    Соблюдает общий лимит и лимиты на чат через корзины токенов, склеивает правки
+    одного и того же сообщения (уходит только последний текст) и повторяет вызов
+    после 429 с учётом retry_after. Правки отправляет отдельный поток: он берёт первую
+    правку, чей чат уже может принять запрос, и не ждёт чаты, упёршиеся в лимит, —
+    правка, получившая 429, возвращается в очередь до конца retry_after.
+    """
+
+    GLOBAL_RATE = 30  # сообщений в секунду на бота
+    PRIVATE_CHAT_RATE = 1  # сообщений в секунду в личный чат
+    GROUP_CHAT_RATE = 20 / 60  # сообщений в секунду в группу
+    CHAT_BURST = 3
+    MAX_RETRIES = 3
+    MAX_IDLE_BUCKETS = 1024
+    STATUS_CHAT_INTERVAL = 60  # Не чаще одной фоновой правки статуса в минуту на чат
+
+    def __init__(self, bot, metrics=None, profiler=None):
+        self.bot = bot
+        self.metrics = metrics
+        self.profiler = profiler
+        self.too_many_requests = 0
+        self._lock = Lock()
+        self._edits_changed = Condition(self._lock)
+        self._global = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chats = {}
+        self._pending_edits = OrderedDict()
+        self._editing = None  # Сообщение, правка которого отправляется прямо сейчас
+        self._status_sent = {}  # Чат -> время последней фоновой правки статуса
+        Thread(target=self._edit_loop, daemon=True, name='telegram-edits').start()
+
+    def reply_to(self, message, text, **kwargs):
+        return self._request('sendMessage', message.chat.id,
+                             lambda: self.bot.reply_to(message, text, **kwargs))
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._request('sendMessage', chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    def send_document(self, chat_id, document, **kwargs):
+        def send():
+            # При повторе после 429 файл нужно читать сначала
+            if hasattr(document, 'seek'):
+                document.seek(0)
+            return self.bot.send_document(chat_id, document, **kwargs)
+
+        return self._request('sendDocument', chat_id, send)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        """Ставит правку в очередь; более новая правка того же сообщения заменяет ожидающую."""
+        with self._lock:
+            self._pending_edits[(chat_id, message_id)] = (text, kwargs, current_job_id(), 0, False)
+            self._edits_changed.notify_all()
+
+    def edit_message_text_now(self, text, chat_id, message_id, **kwargs):
+        """Правит сообщение сразу и ждёт ответа Telegram, отменяя ожидающую правку.
+
+        Нужна, когда следом отправляются новые сообщения: они не должны обогнать правку,
+        а устаревшая промежуточная правка — прийти после неё.
+        """
+        key = (chat_id, message_id)
+        with self._lock:
+            while self._editing == key:
+                self._edits_changed.wait()
+            self._pending_edits.pop(key, None)
+        return self._request('editMessageText', chat_id, lambda: self.bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id, **kwargs))
+
+    def update_status(self, text, chat_id, message_id, valid):
+        """Фоновая правка статуса (позиция в очереди): не вытесняет ожидающую правку сообщения
+        и не ставится, если valid() уже ложно, — так она не перепишет более свежий текст.
+
+        Такие правки уходят после всех остальных, только когда корзина чата полна, и не чаще
+        раза в STATUS_CHAT_INTERVAL на чат: ответы с расшифровками не ждут их лимита.
+        Ещё не отправленная правка статуса заменяется более новой.
+        """
+        key = (chat_id, message_id)
+        with self._lock:
+            pending = self._pending_edits.get(key)
+            if (pending is not None and not pending[4]) or not valid():
+                return False
+            self._pending_edits[key] = (text, {}, current_job_id(), 0, True)
+            self._edits_changed.notify_all()
+            return True
+
+    def pending_edits(self):
+        """Сколько правок, не считая фоновых правок статуса, ждут отправки."""
+        with self._lock:
+            return sum(1 for edit in self._pending_edits.values() if not edit[4])
+
+    def __getattr__(self, name):
+        # Служебные методы (get_file, get_me, set_webhook...) не расходуют лимиты на сообщения,
+        # но тоже повторяются после 429
+        method = getattr(self.bot, name)
+        head, *rest = name.split('_')
+        api_method = head + ''.join(part.title() for part in rest)
+        return lambda *args, **kwargs: self._request(api_method, None, lambda: method(*args, **kwargs))
+
+    def _request(self, method, chat_id, send):
+        # Вызов попадает в трассу задачи, от имени которой сделан, вместе с ожиданием лимитов
+        with self.profiler.span(method) if self.profiler is not None else _NULL_SPAN:
+            for attempt in range(self.MAX_RETRIES + 1):
+                if chat_id is not None:
+                    self._acquire(chat_id)
+                try:
+                    return self._call(method, send)
+                except telebot.apihelper.ApiTelegramException as e:
+                    retry_after = self._retry_after(e)
+                    if retry_after is None or attempt == self.MAX_RETRIES:
+                        raise
+                    self._throttle(chat_id, retry_after)
+                    logging.warning(f'Telegram returned 429, retrying in {retry_after} s')
+                    if chat_id is None:
+                        time.sleep(retry_after)
+
+    def _call(self, method, send):
+        # Задержку считаем после ожидания лимитов: она отражает только ответ Telegram
+        started = time.monotonic()
+        try:
+            result = send()
+        except telebot.apihelper.ApiTelegramException as e:
+            self._observe(method, started, e.error_code)
+            raise
+        except Exception:
+            self._observe(method, started, 'network')
+            raise
+        self._observe(method, started)
+        return result
+
+    @staticmethod
+    def _retry_after(error):
+        """retry_after из ответа 429, для остальных ошибок — None."""
+        if error.error_code != 429:
+            return None
+        return ((error.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+
+    def _observe(self, method, started, error=None):
+        if self.metrics is None:
+            return
+        self.metrics.api_seconds.labels(method).observe(time.monotonic() - started)
+        if error == 429:
+            self.metrics.api_too_many_requests.labels(method).inc()
+        elif error is not None:
+            self.metrics.api_errors.labels(method, str(error)).inc()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_BUCKETS:
+                for key in [key for key, value in self._chats.items() if value.is_idle(now)]:
+                    del self._chats[key]
+            rate = self.PRIVATE_CHAT_RATE if chat_id > 0 else self.GROUP_CHAT_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.CHAT_BURST)
+        return bucket
+
+    def _acquire(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._global.reserve(now), self._chat_bucket(chat_id, now).reserve(now))
+        if wait > 0:
+            time.sleep(wait)
+
+    def _throttle(self, chat_id, retry_after):
+        with self._lock:
+            self.too_many_requests += 1
+            now = time.monotonic()
+            bucket = self._global if chat_id is None else self._chat_bucket(chat_id, now)
+            bucket.block(now, retry_after)
+
+    def _edit_loop(self):
+        while True:
+            with self._lock:
+                key, wait = self._next_edit()
+                while key is None:
+                    self._edits_changed.wait(wait)
+                    key, wait = self._next_edit()
+                edit = self._pending_edits.pop(key)
+                self._editing = key
+            try:
+                self._send_edit(key, edit)
+            finally:
+                with self._lock:
+                    self._editing = None
+                    self._edits_changed.notify_all()
+
+    def _send_edit(self, key, edit):
+        chat_id, message_id = key
+        text, kwargs, job_id, attempt, status = edit
+        try:
+            with JobProfiler.activate(job_id):
+                with self.profiler.span('editMessageText') if self.profiler is not None else _NULL_SPAN:
+                    self._call('editMessageText', lambda: self.bot.edit_message_text(
+                        text, chat_id=chat_id, message_id=message_id, **kwargs))
+        except telebot.apihelper.ApiTelegramException as e:
+            retry_after = self._retry_after(e)
+            if retry_after is not None and attempt < self.MAX_RETRIES:
+                # Чат заблокирован до конца retry_after, правка ждёт в очереди, не задерживая остальные.
+                # Если за это время пришла более новая правка, повторять старую незачем
+                self._throttle(chat_id, retry_after)
+                logging.warning(f'Telegram returned 429 for chat {chat_id}, retrying edit in {retry_after} s')
+                with self._lock:
+                    self._pending_edits.setdefault(key, (text, kwargs, job_id, attempt + 1, status))
+            elif 'message is not modified' not in str(e):
+                logging.error(f'Failed to edit message {message_id} in chat {chat_id}: {e}')
+        except Exception as e:
+            logging.error(f'Failed to edit message {message_id} in chat {chat_id}: {e}')
+
+    def _next_edit(self):
+        """Первая ожидающая правка, чей чат уже может принять запрос, иначе время до ближайшей.
+
+        Фоновые правки статуса рассматриваются после остальных. Для выбранной правки токены
+        забираются сразу, под той же блокировкой, — отправка не будет ждать лимита.
+        """
+        now = time.monotonic()
+        wait = None
+        for status in (False, True):
+            for key, edit in self._pending_edits.items():
+                if edit[4] != status:
+                    continue
+                chat = self._chat_bucket(key[0], now)
+                if status:
+                    # Статусу — только незанятый запас чата и не чаще STATUS_CHAT_INTERVAL
+                    since = now - self._status_sent.get(key[0], -self.STATUS_CHAT_INTERVAL)
+                    delay = max(self._global.delay(now), chat.delay(now, chat.capacity),
+                                self.STATUS_CHAT_INTERVAL - since)
+                else:
+                    delay = max(self._global.delay(now), chat.delay(now))
+                if delay <= 0:
+                    self._global.reserve(now)
+                    chat.reserve(now)
+                    if status:
+                        self._mark_status_sent(key[0], now)
+                    return key, None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _mark_status_sent(self, chat_id, now):
+        if len(self._status_sent) >= self.MAX_IDLE_BUCKETS:
+            for key in [key for key, sent in self._status_sent.items() if now - sent >= self.STATUS_CHAT_INTERVAL]:
+                del self._status_sent[key]
+        self._status_sent[chat_id] = now
+
+
+class WebhookServer:
+    """Встроенный многопоточный HTTP-сервер, принимающий обновления Telegram через webhook."""
+
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self, host, port, path, secret_token, on_update):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                if self.path != path:
+                    return self._respond(404)
+                secret = self.headers.get(server.SECRET_HEADER, '')
+                if secret_token and not hmac.compare_digest(secret, secret_token):
+                    logging.warning(f'Rejected webhook request from {self.client_address[0]}: bad secret token')
+                    return self._respond(403)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > server.MAX_BODY_SIZE:
+                    return self._respond(400)
+                body = self.rfile.read(length)
+                try:
+                    on_update(body.decode('utf-8'))
+                except Exception as e:
+                    logging.error(f'Error dispatching webhook update: {e}')
+                    return self._respond(500)
+                self._respond(200)
+
+            def _respond(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def serve_forever(self):
+        logging.info(f'Webhook server listening on port {self.port}')
+        self.httpd.serve_forever()
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True, name='webhook-server').start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
 
 class VoiceBot:
     def __init__(self):
         self.setup()
 
+        # ROLE: all — всё в одном процессе; ingest — приём и доставка без модели;
+        # worker — только распознавание задач из общей очереди QUEUE_URL
+        self.role = os.getenv('ROLE', 'all').lower()
+        if self.role not in ('all', 'ingest', 'worker'):
+            logging.error(f'Unknown ROLE: {self.role}. Available: all, ingest, worker.')
+            exit(1)
+        logging.info(f'Role: {self.role}')
+
         self.api_token = os.getenv('TELEGRAM_BOT_TOKEN')
-        if not self.api_token:
+        if not self.api_token and self.role != 'worker':
             logging.error('API Token not found. Please set it in the environment variables.')
             exit(1)
-        self.bot = telebot.TeleBot(self.api_token)
+        # BOT_THREADS — размер пула telebot, в котором выполняются обработчики обновлений.
+        # Воркер раздельного режима в Telegram не ходит, токен ему не нужен
+        self.bot = telebot.TeleBot(self.api_token or '0:unused', num_threads=max(1, env_int('BOT_THREADS', 2)))
         logging.info('API Token obtained')
 
+        # Метрики Prometheus отдаются на METRICS_HOST:METRICS_PORT (0 — не поднимать HTTP-эндпоинт)
+        self.metrics = Metrics()
+        self.metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.metrics_port = env_int('METRICS_PORT', 9464)
+
+        # PROFILE_MODE — трассы этапов каждой задачи в PROFILE_DIR; PROFILE_JOBS — сколько первых задач
+        # дополнительно профилировать cProfile
+        self.profiler = JobProfiler(os.getenv('PROFILE_MODE', 'False').lower() in ('1', 'true', 'yes'),
+                                    os.getenv('PROFILE_DIR', self.data_path('profiles')),
+                                    env_int('PROFILE_JOBS', 0))
+
+        # Все исходящие вызовы Bot API идут через диспетчер с лимитами и склейкой правок
+        self.api = TelegramDispatcher(self.bot, self.metrics, self.profiler)
+        # Раздельный режим: общая очередь задач, сколько задач держать в ней впереди воркеров,
+        # аренда задачи воркером и способ передачи файлов (path — общий путь, hash — через очередь)
+        self.job_queue = None
+        if self.role != 'all':
+            queue_url = os.getenv('QUEUE_URL', 'sqlite:///' + self.data_path('shared_queue.sqlite3'))
+            self.job_queue = open_job_queue(queue_url, lease=env_int('QUEUE_LEASE_SECONDS', 1800))
+        self.queue_prefetch = max(1, env_int('QUEUE_PREFETCH', 4))
+        self.file_transfer = os.getenv('FILE_TRANSFER', 'path').lower()
+
+        # Данные бота и списки администраторов для /everyone; сбрасываются по chat_member/my_chat_member
+        self.chat_cache = TTLCache(env_int('ADMIN_CACHE_SECONDS', 600))
+
+        # Бюджет памяти на скачанные файлы и декодированный звук; 0 — без ограничения
+        self.memory = MemoryBudget(env_int('MEMORY_BUDGET_MB', 1024) * 1024 * 1024)
+        self.metrics.track_memory(self.memory)
+
+        self.downloads = DownloadManager(
+            self.api_token,
+            max_workers=max(1, env_int('DOWNLOAD_WORKERS', 4)),
+            max_file_size=env_int('MAX_FILE_SIZE_MB', 20) * 1024 * 1024,
+        )
+
+        # Режим webhook включается заданием WEBHOOK_URL, иначе используется long polling
+        self.webhook_url = os.getenv('WEBHOOK_URL', '').rstrip('/')
+        self.webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+        self.webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        self.webhook_port = env_int('WEBHOOK_PORT', 8443)
+        self.webhook_secret = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
         self.debug_chat_id = os.getenv('DEBUG_CHAT_ID')
         if self.debug_chat_id:
             try:
@@ -92,44 +2367,127 @@ class VoiceBot:
         self.debug_mode = os.getenv('DEBUG_MODE', 'False')
         self.debug_mode = self.debug_mode.lower() == 'true'
 
-        self.chat_manager = ChatManager()
-
-        # Загрузка модели с обработкой исключений
-        try:
-            logging.info('Loading Faster-Whisper model...')
-
-            # Определение устройства: используем переменную окружения USE_CUDA или fallback на CPU
-            use_cuda_env = os.getenv('USE_CUDA')
-            if use_cuda_env is not None:
-                use_cuda = use_cuda_env.lower() in ('1', 'true', 'yes')
-                logging.info(f'USE_CUDA env var set: {use_cuda_env} -> use_cuda={use_cuda}')
-            else:
-                use_cuda = False
-                logging.info('USE_CUDA not set, defaulting to CPU (use_cuda=False)')
-
-            device = "cuda" if use_cuda else "cpu"
-            compute_type = "int8" # Устанавливаем тип вычислений в int8
-            model_size = "turbo"
-
-            # Инициализация модели Faster-Whisper
-            # num_workers=1 рекомендуется для стабильности в многопоточных приложениях,
-            # download_root позволяет указать путь для кэширования моделей.
-            self.model = WhisperModel(
-                model_size_or_path=model_size,
-                device=device,
-                compute_type=compute_type,
-                num_workers=1, # Важно для стабильности с потоками
-                download_root="./model_cache" # Опционально, папка для кэша моделей внутри контейнера
+        # Потоковый режим: промежуточный текст показывается не чаще раза в STREAM_EDIT_INTERVAL секунд,
+        # чтобы не упираться в ограничения Telegram на редактирование сообщений
+        self.stream_mode = os.getenv('STREAM_MODE', 'True').lower() in ('1', 'true', 'yes')
+        self.stream_interval = max(1, env_int('STREAM_EDIT_INTERVAL', 3))
+
+        scheduler_policy = os.getenv('SCHEDULER_POLICY', 'fifo').lower()
+        if scheduler_policy not in SCHEDULERS:
+            logging.error(f'Unknown SCHEDULER_POLICY: {scheduler_policy}. '
+                          f'Available: {", ".join(SCHEDULERS)}. Using fifo.')
+            scheduler_policy = 'fifo'
+        scheduler = SCHEDULERS[scheduler_policy](starvation_limit=env_int('STARVATION_SECONDS', 600))
+        logging.info(f'Scheduler policy: {scheduler_policy}')
+        journal = JobJournal(os.getenv('JOURNAL_PATH', self.data_path('jobs.sqlite3')))
+        self.chat_manager = ChatManager(journal, scheduler)
+        self.metrics.track_queue(self.chat_manager)
+
+        # Параметры распознавания; входят в ключ кэша, чтобы смена настроек не отдавала старые результаты
+        self.model_size = "turbo"
+        self.fallback_model_size = os.getenv('FALLBACK_MODEL', '')
+        # LANGUAGE — код языка или auto: язык определяется и запоминается для каждого чата
+        self.language = os.getenv('LANGUAGE', 'auto').lower()
+        self.languages = LanguageProfiles(threshold=float(os.getenv('LANGUAGE_CONFIDENCE', '0.75')),
+                                          recheck_every=env_int('LANGUAGE_RECHECK_EVERY', 20))
+        self.beam_size = 5
+
+        # Записи длиннее LONG_MEDIA_SECONDS распознаются по кускам между паузами, пакетами по LONG_MEDIA_BATCH_SIZE
+        self.long_media_seconds = env_int('LONG_MEDIA_SECONDS', 600)
+        self.long_media_batch_size = max(1, env_int('LONG_MEDIA_BATCH_SIZE', 8))
+
+        # Микропакеты: короткие записи (до SHORT_MEDIA_SECONDS) из очереди распознаются вместе,
+        # до MICRO_BATCH_SIZE штук; воркер ждёт добора пакета не дольше MICRO_BATCH_WAIT_MS.
+        # Выключены по умолчанию: пакетный проход идёт без VAD (см. MicroBatcher)
+        self.planner = DeliveryPlanner()
+        # TRANSCRIPT_MAX_MESSAGES — сколько сообщений занимает расшифровка голосового, дальше — файл .txt
+        self.max_inline_messages = env_int('TRANSCRIPT_MAX_MESSAGES', 10)
+        self.batcher = MicroBatcher(
+            max_batch_size=max(1, env_int('MICRO_BATCH_SIZE', 1)),
+            max_wait=env_int('MICRO_BATCH_WAIT_MS', 200) / 1000,
+            max_duration=env_int('SHORT_MEDIA_SECONDS', 30),
+            metrics=self.metrics,
+        )
+        if self.batcher.max_batch_size > 1:
+            logging.warning(f'Micro-batching enabled (MICRO_BATCH_SIZE={self.batcher.max_batch_size}): '
+                            f'batched recordings are transcribed without VAD, previous-text conditioning '
+                            f'and temperature fallback')
+
+        # Деградация под нагрузкой: пороги отставания очереди в секундах
+        self.load_controller = LoadController(
+            self.chat_manager,
+            greedy_backlog=env_int('DEGRADE_BACKLOG_SECONDS', 300),
+            fallback_backlog=env_int('FALLBACK_BACKLOG_SECONDS', 900),
+            reject_backlog=env_int('REJECT_BACKLOG_SECONDS', 1800),
+            has_fallback_model=bool(self.fallback_model_size),
+        )
+
+        self.cache = TranscriptionCache(
+            os.getenv('CACHE_PATH', self.data_path('transcription_cache.sqlite3')),
+            max_bytes=env_int('CACHE_MAX_MB', 64) * 1024 * 1024,
+            max_age=env_int('CACHE_MAX_AGE_DAYS', 30) * 24 * 3600,
+        )
+
+        self.settings = UserSettings(os.getenv('SETTINGS_PATH', self.data_path('user_settings.sqlite3')))
+
+        # Индекс отпечатков по первым DEDUP_SECONDS секундам записи (0 — выключить); DEDUP_THRESHOLD —
+        # максимальная доля различающихся бит, при которой записи считаются одной и той же
+        dedup_seconds = env_int('DEDUP_SECONDS', 30)
+        self.dedup = None
+        if dedup_seconds > 0:
+            self.dedup = AudioIndex(
+                os.getenv('DEDUP_PATH', self.data_path('fingerprints.sqlite3')),
+                threshold=float(os.getenv('DEDUP_THRESHOLD', '0.35')),
+                seconds=dedup_seconds,
+                max_entries=env_int('DEDUP_MAX_ENTRIES', 10000),
             )
-            logging.info('Faster-Whisper Model loaded')
-        except Exception as e:
-            logging.error(f'Error loading Faster-Whisper model: {e}')
-            exit(1)
+
+        # Пул потоков распознавания: TRANSCRIBE_WORKERS потоков делят MODEL_REPLICAS копий модели
+        self.transcribe_workers = max(1, env_int('TRANSCRIBE_WORKERS', 1))
+        self.model_replicas = min(self.transcribe_workers, max(1, env_int('MODEL_REPLICAS', 1)))
+        # Потоки CTranslate2 делим между воркерами, чтобы они не конкурировали за ядра
+        self.cpu_threads = env_int('CPU_THREADS', max(1, (os.cpu_count() or 1) // self.transcribe_workers))
+
+        # Позиция и ETA в статусных сообщениях ожидающих задач: QUEUE_UPDATE_INTERVAL — не чаще
+        # раза в столько секунд на сообщение (0 — не обновлять, как раньше)
+        self.eta = EtaEstimator(self.transcribe_workers, lambda: self.load_controller.rtf)
+        self.queue_update_interval = env_int('QUEUE_UPDATE_INTERVAL', 30)
+        logging.info(f'Transcription pool: {self.transcribe_workers} worker(s), '
+                     f'{self.model_replicas} model replica(s), {self.cpu_threads} CPU thread(s) per worker')
+
+        # Определение устройства: используем переменную окружения USE_CUDA или fallback на CPU
+        use_cuda_env = os.getenv('USE_CUDA')
+        if use_cuda_env is not None:
+            use_cuda = use_cuda_env.lower() in ('1', 'true', 'yes')
+            logging.info(f'USE_CUDA env var set: {use_cuda_env} -> use_cuda={use_cuda}')
+        else:
+            use_cuda = False
+            logging.info('USE_CUDA not set, defaulting to CPU (use_cuda=False)')
+        self.device = "cuda" if use_cuda else "cpu"
+
+        # Модели загружаются в фоне после start(): бот сразу принимает файлы в очередь,
+        # а воркеры распознавания запускаются, когда модели загружены и прогреты
+        self.models = []
+        self.model = None
+        self.fallback_model = None
+        self.readiness = 'loading'
+        self.models_ready = Event()
+        self.started_at = time.time()
+        self.model_load_seconds = None
+
+    def data_path(self, name):
+        return os.path.join(self.data_dir, name)
 
     def setup(self):
-        self.voice_folder = 'voice_messages'
-        self.video_note_folder = 'video_notes'
-        self.media_folder = 'media'
+        # DATA_DIR — каталог для журнала задач, баз SQLite и временных файлов (по умолчанию рабочий
+        # каталог). В Docker это том /app/data: он переживает пересоздание контейнера при деплое
+        self.data_dir = os.getenv('DATA_DIR', '.')
+        os.makedirs(self.data_dir, exist_ok=True)
+        # SCRATCH_DIR — каталог для временных файлов (например, tmpfs); по умолчанию DATA_DIR
+        scratch_dir = os.getenv('SCRATCH_DIR', self.data_dir)
+        self.voice_folder = os.path.join(scratch_dir, 'voice_messages')
+        self.video_note_folder = os.path.join(scratch_dir, 'video_notes')
+        self.media_folder = os.path.join(scratch_dir, 'media')
 
         os.makedirs(self.voice_folder, exist_ok=True)
         logging.info('Voice messages folder is ready')
@@ -142,29 +2500,213 @@ class VoiceBot:
 
     def start(self):
         logging.info('Bot started')
-        threading_list = [
-            Thread(target=self.voice_handler, daemon=True),
-            #Thread(target=self.queue_manager, daemon=True)
-        ]
+        self.metrics.track_health(self.health)
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_host, self.metrics_port)
+        if self.role == 'worker':
+            self.load_models()
+            for thread in self.worker_threads:
+                thread.join()
+            return
+
+        self.recover_jobs()
+        if self.role == 'ingest':
+            # Моделей здесь нет: задачи уходят в общую очередь, результаты приходят обратно
+            self.readiness = 'ready'
+            self.models_ready.set()
+            Thread(target=self.dispatch_jobs, daemon=True, name='dispatcher').start()
+            Thread(target=self.collect_results, daemon=True, name='results').start()
+        elif self.readiness == 'loading':
+            Thread(target=self.load_models, daemon=True, name='model-loader').start()
+
+        if self.queue_update_interval > 0:
+            Thread(target=self.queue_manager, daemon=True, name='queue-updates').start()
+
+        self.register_handlers()
+        if self.webhook_url:
+            self.start_webhook()
+        else:
+            self.api.remove_webhook()
+            self.bot.polling(allowed_updates=ALLOWED_UPDATES)
 
-        for thread in threading_list:
+    def load_models(self):
+        """Загружает и прогревает модели, затем запускает воркеры распознавания."""
+        started = time.time()
+        try:
+            logging.info('Loading Faster-Whisper model...')
+            # Каждая реплика обслуживает свою долю воркеров: num_workers у CTranslate2
+            # должен быть не меньше числа потоков, одновременно вызывающих transcribe.
+            workers_per_replica = -(-self.transcribe_workers // self.model_replicas)
+            models = [
+                load_whisper_model(self.device, num_workers=workers_per_replica, cpu_threads=self.cpu_threads,
+                                   model_size=self.model_size)
+                for _ in range(self.model_replicas)
+            ]
+            logging.info('Faster-Whisper Model loaded')
+
+            # Запасная модель поменьше для работы под нагрузкой, общая для всех воркеров
+            fallback_model = None
+            if self.fallback_model_size:
+                fallback_model = load_whisper_model(
+                    self.device, num_workers=self.transcribe_workers, cpu_threads=self.cpu_threads,
+                    model_size=self.fallback_model_size)
+                logging.info(f'Fallback model {self.fallback_model_size} loaded')
+
+            self.readiness = 'warming_up'
+            for model in models:
+                self.warm_up(model)
+            if fallback_model is not None:
+                self.warm_up(fallback_model)
+        except Exception as e:
+            logging.error(f'Error loading Faster-Whisper model: {e}')
+            self.readiness = 'failed'
+            # Без модели бот бесполезен: завершаем процесс, чтобы его перезапустил супервизор
+            os._exit(1)
+
+        self.models = models
+        self.model = models[0]
+        self.fallback_model = fallback_model
+        self.model_load_seconds = time.time() - started
+        self.readiness = 'ready'
+        self.models_ready.set()
+        logging.info(f'Models ready in {self.model_load_seconds:.1f} s, '
+                     f'{self.chat_manager.state_counts["queued"]} job(s) waiting')
+
+        handler = self.remote_worker if self.role == 'worker' else self.voice_handler
+        self.worker_threads = [
+            Thread(target=handler, args=(self.models[index % self.model_replicas],),
+                   daemon=True, name=f'transcriber-{index}')
+            for index in range(self.transcribe_workers)
+        ]
+        for thread in self.worker_threads:
             thread.start()
 
-        self.register_handlers()
-        self.bot.polling()
+    def warm_up(self, model):
+        """Короткое распознавание тишины: выделяет буферы и прогревает кэши до первой настоящей задачи."""
+        started = time.time()
+        segments, _ = model.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32), language=self.fixed_language(),
+                                       beam_size=1)
+        for _ in segments:
+            pass
+        logging.info(f'Model warm-up took {time.time() - started:.2f} s')
+
+    def health(self):
+        return {
+            'status': self.readiness,
+            'ready': self.models_ready.is_set(),
+            'uptime': round(time.time() - self.started_at, 1),
+            'model_load_seconds': self.model_load_seconds and round(self.model_load_seconds, 1),
+            'queued': self.chat_manager.state_counts['queued'],
+        }
+
+    def readiness_text(self):
+        if self.role == 'ingest':
+            return f"Workers: shared queue, {self.job_queue.pending_count()} job(s) waiting for a worker"
+        if self.models_ready.is_set():
+            return f"Model: ready (loaded in {self.model_load_seconds:.1f} s)"
+        return (f"Model: {self.readiness.replace('_', ' ')} for {time.time() - self.started_at:.0f} s, "
+                f"files are queued and will be processed once it is ready")
+
+    def recover_jobs(self):
+        """Возвращает в очередь задачи из журнала и удаляет временные файлы, не принадлежащие ни одной из них.
+
+        В раздельном режиме задачи, уже переданные в общую очередь, остаются в работе: их
+        распознают воркеры, а результат доставит collect_results. Задачи, взятые из локальной
+        очереди, но так и не переданные, возвращаются в неё.
+        """
+        journal = self.chat_manager.journal
+        known_paths = set()
+        restored = 0
+        dispatched = 0
+        downloads = []
+        kept_blobs = set()
+        abandoned_blobs = set()
+        for job in journal.unfinished():
+            path = job.get('path')
+            has_file = bool(path) and os.path.exists(path)
+            if self.job_queue is not None and job['state'] == 'transcribing' and job.get('dispatched'):
+                if has_file:
+                    job['file_bytes'] = os.path.getsize(path)
+                    self.memory.charge(job['file_bytes'])
+                    known_paths.add(os.path.abspath(path))
+                if job.get('file_hash'):
+                    kept_blobs.add(job['file_hash'])
+                self.chat_manager.resume(job, 'transcribing')
+                dispatched += 1
+                continue
+            requeue = job['state'] == 'queued' or (self.job_queue is not None and job['state'] == 'transcribing')
+            if requeue and has_file:
+                job['file_bytes'] = os.path.getsize(path)
+                self.memory.charge(job['file_bytes'])
+                self.chat_manager.restore_chat(job)
+                known_paths.add(os.path.abspath(path))
+                restored += 1
+                continue
+            if job['state'] in ('downloading', 'queued') and job.get('file_id'):
+                # Файл не успел скачаться (или пропал из SCRATCH_DIR) — скачиваем его заново
+                job.pop('file_bytes', None)
+                self.chat_manager.resume(job, 'downloading')
+                downloads.append(job)
+                continue
+            # Задача прервана во время распознавания или доставки — сообщаем пользователю
+            journal.remove(job['id'])
+            if job.get('file_hash'):
+                abandoned_blobs.add(job['file_hash'])
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text=INTERRUPTED_TEXT)
+
+        # Копии файлов брошенных задач в общей очереди больше никому не нужны
+        for digest in abandoned_blobs - kept_blobs:
+            try:
+                self.job_queue.drop_blob(digest)
+            except Exception as e:
+                logging.error(f'Failed to drop shared file {digest}: {e}')
+
+        removed = 0
+        for folder in (self.voice_folder, self.video_note_folder, self.media_folder):
+            for name in os.listdir(folder):
+                file_path = os.path.abspath(os.path.join(folder, name))
+                if file_path in known_paths or not os.path.isfile(file_path):
+                    continue
+                try:
+                    os.remove(file_path)
+                    removed += 1
+                except OSError as e:
+                    logging.error(f'Failed to remove orphaned file {file_path}: {e}')
+        logging.info(f'Recovered {restored} queued job(s), {dispatched} dispatched to workers, '
+                     f'{len(downloads)} to download again, removed {removed} orphaned file(s)')
+        # Загрузки стартуют после уборки, чтобы она не удалила их недокачанные файлы
+        for job in downloads:
+            self.downloads.submit(self.resume_download, job)
+
+    def start_webhook(self):
+        server = WebhookServer(self.webhook_host, self.webhook_port, self.webhook_path,
+                               self.webhook_secret, self.process_webhook_update)
+        self.api.set_webhook(url=self.webhook_url + self.webhook_path, secret_token=self.webhook_secret,
+                             allowed_updates=ALLOWED_UPDATES)
+        logging.info(f'Webhook set to {self.webhook_url}{self.webhook_path}')
+        try:
+            server.serve_forever()
+        finally:
+            server.shutdown()
+
+    def process_webhook_update(self, body):
+        """Передаёт обновление из webhook тем же обработчикам, что и при polling."""
+        update = telebot.types.Update.de_json(body)
+        self.bot.process_new_updates([update])
 
     def register_handlers(self):
         @self.bot.message_handler(content_types=['voice'])
         def handle_voice(message):
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             self.process_voice_message(message)
 
         @self.bot.message_handler(content_types=['video_note'])
         def handle_video_note(message):
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             self.process_video_note_message(message)
 
@@ -174,7 +2716,7 @@ class VoiceBot:
             if message.chat.type != 'private':
                 return
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             self.process_audio_message(message)
 
@@ -184,7 +2726,7 @@ class VoiceBot:
             if message.chat.type != 'private':
                 return
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             self.process_video_message(message)
 
@@ -194,160 +2736,294 @@ class VoiceBot:
             if message.chat.type != 'private':
                 return
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             self.process_document_message(message)
 
         @self.bot.message_handler(commands=['check'])
         def check_queue(message):
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             chat_data = self.chat_manager.display_chats()
-            self.bot.reply_to(message, chat_data)
+            chat_data += "\n" + self.readiness_text()
+            chat_data += "\n" + self.language_text(message.chat.id)
+            cache_stats = self.cache.stats()
+            chat_data += (f"\nCache: hits: {cache_stats['hits']}, misses: {cache_stats['misses']}, "
+                          f"entries: {cache_stats['entries']}")
+            if self.dedup is not None:
+                dedup_stats = self.dedup.stats()
+                chat_data += (f"\nDedup: hits: {dedup_stats['hits']} of {dedup_stats['lookups']}, "
+                              f"saved: {dedup_stats['saved_seconds']:.0f} model s, entries: {dedup_stats['entries']}")
+            chat_data += (f"\nLoad: {LoadController.LEVELS[self.load_controller.level]}, "
+                          f"backlog: {self.load_controller.backlog_seconds():.0f} s")
+            batch_stats = self.batcher.stats()
+            chat_data += (f"\nBatches: {batch_stats['batches']}, jobs: {batch_stats['batched_jobs']}, "
+                          f"average size: {batch_stats['average_size']:.1f}, "
+                          f"average wait: {batch_stats['average_wait'] * 1000:.0f} ms")
+            self.api.reply_to(message, chat_data)
+
+        @self.bot.message_handler(commands=['format'])
+        def set_format(message):
+            if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                return
+            self.process_format_command(message)
 
         @self.bot.message_handler(commands=['everyone'])
         def ping_all(message):
             if self.debug_mode and self.debug_chat_id and message.chat.id != self.debug_chat_id:
-                self.bot.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
+                self.api.reply_to(message, 'В данный момент бот находится на обслуживании, приносим извинения')
                 return
             self.process_ping_all(message)
 
-    def process_voice_message(self, message):
+        @self.bot.my_chat_member_handler()
+        @self.bot.chat_member_handler()
+        def chat_member_changed(update):
+            # Кого-то (или самого бота) повысили, понизили или исключили — список администраторов устарел
+            self.chat_cache.invalidate(('administrators', update.chat.id))
+
+    def ingest_media(self, message, media, media_type, folder, prefix, ext, missing_file_text):
+        """Принимает медиа: проверяет размер и передаёт скачивание пулу загрузок, не блокируя обработчик."""
+        file_size = getattr(media, 'file_size', None) or 0
+        if file_size > self.downloads.max_file_size:
+            self.api.reply_to(message, self.file_too_large_text())
+            return
+        if self.is_long_media(media, media_type) and self.load_controller.should_reject():
+            logging.warning(f'Rejected {media_type} message in chat {message.chat.id}: bot is overloaded')
+            self.api.reply_to(message, 'Бот сейчас перегружен, поэтому длинные файлы временно не принимаются. '
+                                       'Попробуйте отправить файл позже.')
+            return
+        self.downloads.submit(self.download_media, message, media, media_type, folder, prefix, ext,
+                              missing_file_text)
+
+    def download_media(self, message, media, media_type, folder, prefix, ext, missing_file_text):
+        """Единый путь приёма медиа: скачивает исходный файл как есть и ставит его в очередь.
+
+        Декодирование в 16 кГц моно выполняет воркер распознавания, поэтому видео
+        больше не перекодируется в mp3 и не пишется на диск повторно.
+        """
+        export = self.export_format(message, media_type)
+        # В кэше только текст без таймкодов
+        if export is None and self.reply_from_cache(message, media, media_type):
+            return
+
+        job = None
         try:
-            sent_message = self.bot.reply_to(message, 'В очереди...')
-            file_info = self.bot.get_file(message.voice.file_id)
-            # Проверяем, что file_path присутствует, прежде чем скачивать
-            file_path = getattr(file_info, 'file_path', None)
-            if not file_path:
-                logging.error('File path is missing in file_info for voice message')
-                self.bot.reply_to(message, 'Не удалось получить файл для распознавания.')
-                return
-            downloaded_file = self.bot.download_file(file_path)
-
-            file_name = os.path.join(
-                self.voice_folder, f"voice_{message.from_user.id}_{message.message_id}.ogg")
-
-            with open(file_name, 'wb') as voice_file:
-                voice_file.write(downloaded_file)
-
-            self.chat_manager.add_chat(message.chat.id, sent_message.message_id, file_name)
+            sent_message = self.api.reply_to(message, 'В очереди...')
+            # file_id и путь файла пишутся в журнал сразу: задачу, прерванную перезапуском во время
+            # скачивания или ожидания бюджета памяти, можно скачать заново
+            file_name = os.path.join(folder, f"{prefix}_{message.from_user.id}_{message.message_id}{ext}")
+            job = self.chat_manager.start_download(message.chat.id, sent_message.message_id, media_type,
+                                                   cache_key=self.cache_key(media),
+                                                   duration=getattr(media, 'duration', None), export=export,
+                                                   file_id=media.file_id, file_size=getattr(media, 'file_size', None),
+                                                   destination=file_name)
+            set_current_job(job['id'])
+            if not self.fetch_media(job):
+                logging.error(f'File path is missing in file_info for {media_type}')
+                self.api.reply_to(message, missing_file_text)
+        except FileTooLargeError as e:
+            logging.warning(f'Rejected {media_type} message: {e}')
+            self.api.edit_message_text(chat_id=message.chat.id, message_id=job['message_id'],
+                                       text=self.file_too_large_text())
         except Exception as e:
-            logging.error(f'Error processing voice message: {e}')
+            logging.error(f'Error processing {media_type} message: {e}')
+        finally:
+            self.end_download(job)
 
-    def process_video_note_message(self, message):
+    def resume_download(self, job):
+        """Скачивает заново файл задачи из журнала, прерванной перезапуском до постановки в очередь."""
+        set_current_job(job['id'])
         try:
-            sent_message = self.bot.reply_to(message, 'В очереди...')
-            file_info = self.bot.get_file(message.video_note.file_id)
-            # Проверяем, что file_path присутствует, прежде чем скачивать
-            file_path = getattr(file_info, 'file_path', None)
-            if not file_path:
-                logging.error('File path is missing in file_info for video_note')
-                self.bot.reply_to(message, 'Не удалось получить файл для распознавания.')
-                return
-            downloaded_file = self.bot.download_file(file_path)
-
-            file_name_video = os.path.join(
-                self.video_note_folder, f"video_{message.from_user.id}_{message.message_id}.mp4")
-            file_name_audio = os.path.join(
-                self.video_note_folder, f"video_{message.from_user.id}_{message.message_id}.mp3")
-
-            with open(file_name_video, 'wb') as video_file:
-                video_file.write(downloaded_file)
-
-            audio = AudioSegment.from_file(file_name_video, format="mp4")
-            audio.export(file_name_audio, format="mp3")
-
-            os.remove(file_name_video)
-
-            self.chat_manager.add_chat(message.chat.id, sent_message.message_id, file_name_audio)
+            if not self.fetch_media(job):
+                logging.error(f'File path is missing in file_info for recovered job {job["id"]}')
+                self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                           text=INTERRUPTED_TEXT)
+        except FileTooLargeError as e:
+            logging.warning(f'Rejected recovered {job["media_type"]} job: {e}')
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text=self.file_too_large_text())
         except Exception as e:
-            logging.error(f'Error processing video note: {e}')
-
-    def process_audio_message(self, message):
-        """Обрабатывает отправленные аудиофайлы (не voice): mp3/ogg/m4a/wav и др."""
+            logging.error(f'Error downloading recovered job {job["id"]}: {e}')
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text=INTERRUPTED_TEXT)
+        finally:
+            self.end_download(job)
+
+    def fetch_media(self, job):
+        """Скачивает файл задачи в job['destination'] и ставит задачу в очередь.
+
+        Возвращает False, если Telegram не отдал путь к файлу.
+        """
+        file_info = self.api.get_file(job['file_id'])
+        # Проверяем, что file_path присутствует, прежде чем скачивать
+        file_path = getattr(file_info, 'file_path', None)
+        if not file_path:
+            return False
+
+        # Файл занимает место в бюджете, пока задача не завершится; при переполнении загрузка ждёт
+        expected_size = getattr(file_info, 'file_size', None) or job.get('file_size') or 0
+        with self.profiler.span('memory_wait', bytes=expected_size):
+            self.memory.reserve(expected_size)
+        job['file_bytes'] = expected_size
+        download_start = time.time()
+        with self.profiler.span('download', bytes=expected_size):
+            received = self.downloads.download(file_path, job['destination'])
+        self.metrics.download_seconds.labels(job['media_type']).observe(time.time() - download_start)
+        self.memory.charge(received - expected_size)
+        job['file_bytes'] = received
+
+        self.chat_manager.add_chat(job['chat_id'], job['message_id'], job['destination'], job=job)
+        return True
+
+    def end_download(self, job):
+        """Освобождает бюджет и снимает с учёта задачу, которую так и не удалось поставить в очередь."""
+        if job is not None and job['state'] == 'downloading':
+            self.memory.release(job.get('file_bytes', 0))
+            self.profiler.finish(job['id'])
+        self.chat_manager.cancel_download(job)
+        set_current_job(None)
+
+    def export_format(self, message, media_type):
+        """Формат экспорта с таймкодами, выбранный пользователем, или None для обычной расшифровки.
+
+        Экспорт делается для аудио, видео и документов; голосовые и видеосообщения
+        по-прежнему расшифровываются сообщением.
+        """
+        if media_type not in ('audio', 'video', 'document'):
+            return None
+        export_format = self.settings.get(message.from_user.id, 'export_format', 'txt')
+        return export_format if export_format in TranscriptExport.EXTENSIONS else None
+
+    def process_format_command(self, message):
+        """/format [формат] — показывает или меняет формат расшифровки аудио, видео и документов."""
+        args = (message.text or '').split()[1:]
+        formats = "\n".join(f"{name} — {description}" for name, description in TranscriptExport.FORMATS.items())
+        if not args:
+            current = self.settings.get(message.from_user.id, 'export_format', 'txt')
+            self.api.reply_to(message, f"Текущий формат расшифровки: {current}\n\n"
+                                       f"Доступные форматы (/format <формат>):\n{formats}")
+            return
+        export_format = args[0].lower()
+        if export_format not in TranscriptExport.FORMATS:
+            self.api.reply_to(message, f"Неизвестный формат: {args[0]}\n\nДоступные форматы:\n{formats}")
+            return
+        self.settings.set(message.from_user.id, 'export_format', export_format)
+        self.api.reply_to(message, f"Формат расшифровки аудио, видео и документов: {export_format}")
+
+    def is_long_media(self, media, media_type):
+        if media_type == 'document':
+            return True
+        duration = getattr(media, 'duration', None) or 0
+        return media_type in ('audio', 'video') and duration >= self.long_media_seconds
+
+    def file_too_large_text(self):
+        return (f'Файл слишком большой для распознавания. '
+                f'Максимальный размер: {self.downloads.max_file_size // (1024 * 1024)} МБ.')
+
+    def transcript_variant(self):
+        """Настройки, от которых зависит текст расшифровки: разные варианты не подменяют друг друга."""
+        return f"{self.model_size}:{self.language}:{self.beam_size}"
+
+    def cache_key(self, media):
+        return f"{media.file_unique_id}:{self.transcript_variant()}"
+
+    def find_duplicate(self, job, audio):
+        """Ищет ту же запись среди уже распознанных по акустическому отпечатку.
+
+        Возвращает расшифровку найденной копии или None и отпечаток для remember_transcription.
+        """
+        if self.dedup is None or job.get('export'):
+            return None, None
+        audio_seconds = len(audio) / SAMPLE_RATE
+        with self.profiler.span('fingerprint'):
+            fingerprint = audio_fingerprint(audio, self.dedup.seconds)
+            if fingerprint is None:
+                return None, None
+            text = self.dedup.lookup(fingerprint, audio_seconds, self.transcript_variant())
+        if text is not None:
+            # Сэкономленное время модели оцениваем по текущему RTF
+            saved_seconds = audio_seconds * self.load_controller.rtf
+            self.dedup.record_saving(saved_seconds)
+            self.metrics.observe_duplicate(job, saved_seconds)
+            logging.info(f'{media_label(job)} of {audio_seconds:.0f} s matches an already transcribed recording')
+        return text, fingerprint
+
+    def remember_transcription(self, fingerprint, audio, transcription):
+        if fingerprint is not None and transcription.strip():
+            self.dedup.add(fingerprint, len(audio) / SAMPLE_RATE, self.transcript_variant(), transcription)
+
+    def reply_from_cache(self, message, media, media_type):
+        """Отвечает сохранённой расшифровкой без скачивания и распознавания. Возвращает True при попадании."""
         try:
-            sent_message = self.bot.reply_to(message, 'В очереди...')
-            file_info = self.bot.get_file(message.audio.file_id)
-            file_path = getattr(file_info, 'file_path', None)
-            if not file_path:
-                logging.error('File path is missing in file_info for audio')
-                self.bot.reply_to(message, 'Не удалось получить аудиофайл для распознавания.')
-                return
-            downloaded_file = self.bot.download_file(file_path)
-
-            # Определяем расширение
-            file_name_attr = getattr(message.audio, 'file_name', None)
-            mime_type = getattr(message.audio, 'mime_type', '') or ''
-            ext = None
-            if file_name_attr and '.' in file_name_attr:
-                ext = os.path.splitext(file_name_attr)[1]
-            if not ext:
-                # По mime type
-                mime_to_ext = {
-                    'audio/mpeg': '.mp3',
-                    'audio/mp3': '.mp3',
-                    'audio/ogg': '.ogg',
-                    'audio/opus': '.opus',
-                    'audio/x-m4a': '.m4a',
-                    'audio/mp4': '.m4a',
-                    'audio/wav': '.wav',
-                    'audio/webm': '.webm',
-                    'audio/flac': '.flac',
-                }
-                ext = mime_to_ext.get(mime_type, '.mp3')
-
-            file_name = os.path.join(
-                self.media_folder, f"audio_{message.from_user.id}_{message.message_id}{ext}")
-
-            with open(file_name, 'wb') as f:
-                f.write(downloaded_file)
-
-            self.chat_manager.add_chat(message.chat.id, sent_message.message_id, file_name)
+            transcription = self.cache.get(self.cache_key(media))
         except Exception as e:
-            logging.error(f'Error processing audio message: {e}')
+            logging.error(f'Error reading transcription cache: {e}')
+            return False
+        if transcription is None:
+            return False
 
-    def process_video_message(self, message):
-        """Обрабатывает отправленные видеофайлы: mp4/mov/webm и др., извлекает аудио в mp3."""
+        logging.info(f'Cache hit for {media_type} {media.file_unique_id}')
         try:
-            sent_message = self.bot.reply_to(message, 'В очереди...')
-            file_info = self.bot.get_file(message.video.file_id)
-            file_path = getattr(file_info, 'file_path', None)
-            if not file_path:
-                logging.error('File path is missing in file_info for video')
-                self.bot.reply_to(message, 'Не удалось получить видеофайл для распознавания.')
-                return
-            downloaded_file = self.bot.download_file(file_path)
-
-            # Определяем расширение видео
-            mime_type = getattr(message.video, 'mime_type', '') or ''
-            default_video_ext = '.mp4'
-            if 'webm' in mime_type:
-                default_video_ext = '.webm'
-            elif 'quicktime' in mime_type:
-                default_video_ext = '.mov'
+            sent_message = self.api.reply_to(message, 'Распознавание...')
+            job = {
+                "chat_id": message.chat.id,
+                "message_id": sent_message.message_id,
+                "path": None,
+                "media_type": media_type,
+            }
+            self.deliver_transcription(job, transcription, 0.0)
+        except Exception as e:
+            logging.error(f'Error replying from cache: {e}')
+        return True
 
-            file_name_video = os.path.join(
-                self.media_folder, f"video_{message.from_user.id}_{message.message_id}{default_video_ext}")
-            file_name_audio = os.path.join(
-                self.media_folder, f"video_{message.from_user.id}_{message.message_id}.mp3")
+    def process_voice_message(self, message):
+        self.ingest_media(message, message.voice, 'voice', self.voice_folder, 'voice', '.ogg',
+                          'Не удалось получить файл для распознавания.')
 
-            with open(file_name_video, 'wb') as vf:
-                vf.write(downloaded_file)
+    def process_video_note_message(self, message):
+        self.ingest_media(message, message.video_note, 'video_note', self.video_note_folder, 'video', '.mp4',
+                          'Не удалось получить файл для распознавания.')
 
-            try:
-                audio = AudioSegment.from_file(file_name_video)
-                audio.export(file_name_audio, format="mp3")
-            finally:
-                # Удаляем исходное видео независимо от успеха экспорта
-                try:
-                    os.remove(file_name_video)
-                except Exception:
-                    pass
+    def process_audio_message(self, message):
+        """Обрабатывает отправленные аудиофайлы (не voice): mp3/ogg/m4a/wav и др."""
+        # Определяем расширение
+        file_name_attr = getattr(message.audio, 'file_name', None)
+        mime_type = getattr(message.audio, 'mime_type', '') or ''
+        ext = None
+        if file_name_attr and '.' in file_name_attr:
+            ext = os.path.splitext(file_name_attr)[1]
+        if not ext:
+            # По mime type
+            mime_to_ext = {
+                'audio/mpeg': '.mp3',
+                'audio/mp3': '.mp3',
+                'audio/ogg': '.ogg',
+                'audio/opus': '.opus',
+                'audio/x-m4a': '.m4a',
+                'audio/mp4': '.m4a',
+                'audio/wav': '.wav',
+                'audio/webm': '.webm',
+                'audio/flac': '.flac',
+            }
+            ext = mime_to_ext.get(mime_type, '.mp3')
+
+        self.ingest_media(message, message.audio, 'audio', self.media_folder, 'audio', ext,
+                          'Не удалось получить аудиофайл для распознавания.')
 
-            self.chat_manager.add_chat(message.chat.id, sent_message.message_id, file_name_audio)
-        except Exception as e:
-            logging.error(f'Error processing video message: {e}')
+    def process_video_message(self, message):
+        """Обрабатывает отправленные видеофайлы: mp4/mov/webm и др."""
+        # Определяем расширение видео
+        mime_type = getattr(message.video, 'mime_type', '') or ''
+        default_video_ext = '.mp4'
+        if 'webm' in mime_type:
+            default_video_ext = '.webm'
+        elif 'quicktime' in mime_type:
+            default_video_ext = '.mov'
+
+        self.ingest_media(message, message.video, 'video', self.media_folder, 'video', default_video_ext,
+                          'Не удалось получить видеофайл для распознавания.')
 
     def process_document_message(self, message):
         """Обрабатывает документы: если это аудио/видео — обрабатываем как соответствующий тип."""
@@ -364,246 +3040,639 @@ class VoiceBot:
                 return e in {'.mp4', '.mov', '.mkv', '.webm', '.avi'}
 
             if mime_type.startswith('audio/') or is_audio_ext(ext):
-                # Скачиваем и кладем как аудио
-                sent_message = self.bot.reply_to(message, 'В очереди...')
-                file_info = self.bot.get_file(doc.file_id)
-                file_path = getattr(file_info, 'file_path', None)
-                if not file_path:
-                    logging.error('File path is missing in file_info for document(audio)')
-                    self.bot.reply_to(message, 'Не удалось получить файл для распознавания.')
-                    return
-                downloaded_file = self.bot.download_file(file_path)
-
                 ext_to_use = ext if is_audio_ext(ext) else '.mp3'
-                file_name = os.path.join(
-                    self.media_folder, f"doc_audio_{message.from_user.id}_{message.message_id}{ext_to_use}")
-                with open(file_name, 'wb') as f:
-                    f.write(downloaded_file)
-                self.chat_manager.add_chat(message.chat.id, sent_message.message_id, file_name)
+                self.ingest_media(message, doc, 'document', self.media_folder, 'doc_audio', ext_to_use,
+                                  'Не удалось получить файл для распознавания.')
                 return
 
             if mime_type.startswith('video/') or is_video_ext(ext):
-                # Скачиваем и обрабатываем как видео (извлекаем аудио)
-                sent_message = self.bot.reply_to(message, 'В очереди...')
-                file_info = self.bot.get_file(doc.file_id)
-                file_path = getattr(file_info, 'file_path', None)
-                if not file_path:
-                    logging.error('File path is missing in file_info for document(video)')
-                    self.bot.reply_to(message, 'Не удалось получить файл для распознавания.')
-                    return
-                downloaded_file = self.bot.download_file(file_path)
-
                 video_ext = ext if is_video_ext(ext) else '.mp4'
-                file_name_video = os.path.join(
-                    self.media_folder, f"doc_video_{message.from_user.id}_{message.message_id}{video_ext}")
-                file_name_audio = os.path.join(
-                    self.media_folder, f"doc_video_{message.from_user.id}_{message.message_id}.mp3")
-                with open(file_name_video, 'wb') as vf:
-                    vf.write(downloaded_file)
-                try:
-                    audio = AudioSegment.from_file(file_name_video)
-                    audio.export(file_name_audio, format="mp3")
-                finally:
-                    try:
-                        os.remove(file_name_video)
-                    except Exception:
-                        pass
-                self.chat_manager.add_chat(message.chat.id, sent_message.message_id, file_name_audio)
+                self.ingest_media(message, doc, 'document', self.media_folder, 'doc_video', video_ext,
+                                  'Не удалось получить файл для распознавания.')
                 return
 
             # Тип документа не поддерживается
-            self.bot.reply_to(message, 'Этот тип документа не поддерживается для распознавания.')
+            self.api.reply_to(message, 'Этот тип документа не поддерживается для распознавания.')
         except Exception as e:
             logging.error(f'Error processing document message: {e}')
 
-    def voice_handler(self):
+    def voice_handler(self, model):
         while True:
-            if not self.chat_manager.is_empty():
-                first_chat = self.chat_manager.get_first_chat()
-                if first_chat:
-                    chat_id = first_chat['chat_id']
-                    message_id = first_chat['message_id']
-                    path = first_chat['path']
-                    try:
-                        self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                   text="Распознавание...", parse_mode='HTML')
-
-                        start_time = time.time()
-                        segments, info = self.model.transcribe(
-                            path,
-                            language='ru',
-                            beam_size=5, # Можно настроить для баланса скорости/качества
-                            vad_filter=True # Используем встроенный VAD для лучшей обработки пауз
-                        )
-                        # Собираем весь текст из сегментов
-                        transcription = " ".join([segment.text for segment in segments])
-                        duration = time.time() - start_time
-
-                        # Максимальная длина сообщения и определение типа носителя
-                        max_length = 3696  # Максимальная длина сообщения с запасом под HTML
-                        is_voice_or_vnote = (
-                            path.startswith(self.voice_folder) or path.startswith(self.video_note_folder)
-                        )
-
-                        if not transcription.strip():
-                            # Если расшифровка пустая — обновляем сообщение, чтобы не оставлять 'Распознавание...'
-                            no_text = "Ничего не распознано."
-                            if self.debug_mode:
-                                no_text += f"\nВремя распознавания: {duration:.2f} секунд"
-                            try:
-                                self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                           text=no_text,
-                                                           parse_mode='HTML')
-                            except Exception as e:
-                                logging.error(f'Failed to update empty transcription message: {e}')
-                        else:
-                            if is_voice_or_vnote:
-                                # Для voice и video_note оставляем поведение с разбиением на несколько сообщений
-                                messages = self.split_text(transcription, max_length)
-                                if messages:
-                                    first_message_text = f"<blockquote expandable>{messages[0]}</blockquote>"
-                                    if self.debug_mode:
-                                        first_message_text += f"\nВремя распознавания: {duration:.2f} секунд"
-                                    try:
-                                        self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                                   text=first_message_text, parse_mode='HTML')
-                                    except Exception as e:
-                                        logging.error(f'Failed to edit message with transcription: {e}')
-
-                                    previous_message_id = message_id
-                                    for msg in messages[1:]:
-                                        time.sleep(2)
-                                        sent_message = self.bot.send_message(
-                                            chat_id=chat_id,
-                                            text=f"<blockquote expandable>{msg}</blockquote>",
-                                            parse_mode='HTML',
-                                            reply_to_message_id=previous_message_id
-                                        )
-                                        previous_message_id = sent_message.message_id
-                            else:
-                                # Для audio/video/document (обрабатываются в ЛС):
-                                # Если текст помещается — отправляем одно сообщение, иначе — присылаем .txt файл
-                                if len(transcription) <= max_length:
-                                    text_msg = f"<blockquote expandable>{transcription}</blockquote>"
-                                    if self.debug_mode:
-                                        text_msg += f"\nВремя распознавания: {duration:.2f} секунд"
-                                    try:
-                                        self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                                   text=text_msg, parse_mode='HTML')
-                                    except Exception as e:
-                                        logging.error(f'Failed to edit single-message transcription: {e}')
-                                else:
-                                    # Генерируем txt-файл с полной расшифровкой
-                                    base_name = os.path.splitext(os.path.basename(path))[0]
-                                    txt_dir = self.media_folder if os.path.isdir(self.media_folder) else '.'
-                                    txt_path = os.path.join(txt_dir, f"{base_name}.txt")
-                                    try:
-                                        with open(txt_path, 'w', encoding='utf-8') as f:
-                                            f.write(transcription)
-                                        caption = None
-                                        if self.debug_mode:
-                                            caption = f"Время распознавания: {duration:.2f} секунд"
-                                        with open(txt_path, 'rb') as doc:
-                                            self.bot.send_document(chat_id=chat_id, document=doc, caption=caption)
-                                        # Обновляем исходное сообщение
-                                        try:
-                                            self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                                       text="Расшифровка отправлена файлом.")
-                                        except Exception as e:
-                                            logging.error(f'Failed to edit message after sending txt: {e}')
-                                    except Exception as e:
-                                        logging.error(f'Failed to create/send transcription txt: {e}')
-                                        # Фоллбэк: если не удалось отправить файл — сокращенно отправим как одно сообщение, обрезав текст
-                                        fallback_text = transcription[:max_length - 3] + '...'
-                                        try:
-                                            self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                                       text=f"<blockquote expandable>{fallback_text}</blockquote>",
-                                                                       parse_mode='HTML')
-                                        except Exception as e2:
-                                            logging.error(f'Failed to edit message with fallback text: {e2}')
-                                    finally:
-                                        # Пытаемся удалить временный txt
-                                        try:
-                                            if os.path.exists(txt_path):
-                                                os.remove(txt_path)
-                                        except Exception:
-                                            pass
-
-                    except Exception as e:
-                        logging.error(f'Error during transcription: {e}')
-                        self.bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                                   text="Ошибка во время распознавания",
-                                                   parse_mode='HTML')
-                    finally:
-                        os.remove(path)
-                        self.chat_manager.remove_chat()
+            job = self.chat_manager.take_chat()
+            if not job:
+                continue
+            with JobProfiler.activate(job['id']):
+                self.process_taken_job(job, model)
+
+    def process_taken_job(self, job, model):
+        self.observe_wait(job)
+        job['language'] = self.choose_language(job)
+        # Пакет распознаётся на одном языке: записи с неизвестным языком идут по одной
+        # Экспорт с таймкодами делается по сегментам отдельной записи, такие задачи не пакетируются
+        if self.batcher.accepts(job) and job['language'] is not None and not job.get('export'):
+            batch = self.batcher.collect(self.chat_manager, job,
+                                         lambda other: self.same_language(job, other) and not other.get('export'))
+            for batched_job in batch[1:]:
+                batched_job['language'] = job['language']
+                self.observe_wait(batched_job)
+            if len(batch) > 1:
+                self.process_batch(batch, model)
+                return
+        with self.profiler.sample(job['id']):
+            self.process_job(job, model)
+
+    def observe_wait(self, job):
+        if job.get('queued_at'):
+            self.metrics.wait_seconds.labels(media_label(job)).observe(time.time() - job['queued_at'])
+            self.profiler.add_span(job['id'], 'queue', job['queued_at'], time.time())
+
+    def decode(self, job):
+        """Декодирует файл задачи одним проходом PyAV прямо в 16 кГц моно float32, без промежуточных файлов."""
+        decode_start = time.time()
+        with self.profiler.span('decode'):
+            audio = decode_pcm(job['path'], job.get('duration'))
+        self.metrics.decode_seconds.labels(media_label(job)).observe(time.time() - decode_start)
+        self.memory.charge(audio.nbytes)
+        job['pcm_bytes'] = audio.nbytes
+        return audio
+
+    def process_job(self, job, model):
+        start_time = time.time()
+        try:
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text="Распознавание...", parse_mode='HTML')
+            audio = self.decode(job)
+        except Exception as e:
+            logging.error(f'Error during transcription: {e}')
+            self.fail_job(job)
+            return
+        self.process_decoded_job(job, model, audio, start_time)
+
+    def process_decoded_job(self, job, model, audio, start_time):
+        chat_id = job['chat_id']
+        message_id = job['message_id']
+        def show_partial(texts):
+            if self.stream_mode:
+                self.show_partial_transcription(chat_id, message_id, texts)
+
+        try:
+            level = self.load_controller.update()
+            duplicate, fingerprint = self.find_duplicate(job, audio)
+            if duplicate is not None:
+                self.chat_manager.set_state(job, 'sending')
+                self.deliver_transcription(job, duplicate, time.time() - start_time)
+                return
+            export = TranscriptExport(job['export']) if job.get('export') else None
+            segments, transcribe_seconds, info = self.run_transcription(job, model, audio, level, show_partial,
+                                                                        export)
+            self.observe_language(job, info.language, info.language_probability)
+            duration = time.time() - start_time
+            self.load_controller.observe(len(audio) / SAMPLE_RATE, transcribe_seconds)
+            self.chat_manager.set_state(job, 'sending')
+            if export is not None:
+                with self.profiler.span('deliver'):
+                    self.send_export(job, export, duration)
+                return
+
+            transcription = join_segments(segments)
+            # Результаты пониженного качества в кэш не попадают
+            if level == 0:
+                if job.get('cache_key'):
+                    self.cache.put(job['cache_key'], transcription)
+                self.remember_transcription(fingerprint, audio, transcription)
+            with self.profiler.span('deliver'):
+                self.deliver_transcription(job, transcription, duration, segments)
+        except Exception as e:
+            logging.error(f'Error during transcription: {e}')
+            self.api.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                       text="Ошибка во время распознавания",
+                                       parse_mode='HTML')
+        finally:
+            self.release_job(job)
+
+    def run_transcription(self, job, model, audio, level, on_progress, export=None):
+        """Распознаёт audio; on_progress(texts) вызывается не чаще раза в stream_interval секунд.
+        Возвращает сегменты (начало, конец, текст[, слова]), время работы модели и info от faster-whisper.
+        С export сегменты сразу пишутся в файл экспорта и не возвращаются."""
+        transcribe_start = time.time()
+        word_timestamps = TranscriptExport.word_timestamps(job.get('export'))
+        # faster-whisper сразу выполняет VAD, извлечение признаков и определение языка,
+        # а декодирование идёт по мере чтения сегментов
+        with self.profiler.span('vad_and_features', level=level):
+            segments, info = self.transcribe_audio(self.model_for_level(model, level), audio, level,
+                                                   job.get('language'), word_timestamps)
+        # Сегменты приходят лениво: по ним можно показывать текст по мере распознавания.
+        # Для промежуточного текста нужен только хвост
+        texts = deque(maxlen=PARTIAL_TAIL_SEGMENTS)
+        spans = []
+        last_progress = time.time()
+        with self.profiler.span('transcription', audio_seconds=round(len(audio) / SAMPLE_RATE, 1)):
+            for segment in segments:
+                texts.append(segment.text)
+                span = (segment.start, segment.end, segment.text)
+                if word_timestamps:
+                    span += ([(word.start, word.end, word.word) for word in segment.words or ()],)
+                if export is not None:
+                    export.add(*span)
                 else:
-                    time.sleep(1)
-            else:
-                time.sleep(1)
+                    spans.append(span)
+                if time.time() - last_progress >= self.stream_interval:
+                    on_progress(texts)
+                    last_progress = time.time()
+        transcribe_seconds = time.time() - transcribe_start
+        self.metrics.observe_transcription(job, transcribe_seconds, len(audio) / SAMPLE_RATE)
+        self.eta.observe(job, self.model_name(level), len(audio) / SAMPLE_RATE, transcribe_seconds)
+        return spans, transcribe_seconds, info
+
+    def dispatch_jobs(self):
+        """Раздельный режим, ingest: передаёт задачи из локальной очереди в общую.
+
+        В общей очереди держится не больше queue_prefetch задач, остальные ждут в ChatManager —
+        так порядок по-прежнему задаёт выбранная политика планировщика.
+        """
+        while True:
+            try:
+                if self.job_queue.pending_count() >= self.queue_prefetch:
+                    time.sleep(SQLiteJobQueue.POLL_INTERVAL)
+                    continue
+            except Exception as e:
+                logging.error(f'Shared queue is unavailable: {e}')
+                time.sleep(5)
+                continue
+            job = self.chat_manager.take_chat(timeout=1)
+            if not job:
+                continue
+            self.observe_wait(job)
+            try:
+                self.job_queue.put(self.shared_job(job))
+            except Exception as e:
+                logging.error(f'Failed to dispatch job {job["id"]}: {e}')
+                self.fail_job(job)
+                continue
+            # После перезапуска ingest такая задача ждёт результата воркера, а не считается прерванной
+            job['dispatched'] = True
+            self.chat_manager.save(job)
+
+    def shared_job(self, job):
+        """Описание задачи для воркера: файл передаётся путём на общем томе или хешем содержимого."""
+        job['level'] = self.load_controller.update()
+        job['language'] = self.choose_language(job)
+        shared = {key: job.get(key) for key in ('media_type', 'duration', 'level', 'language', 'export')}
+        shared['job_id'] = job['id']
+        if self.file_transfer == 'hash':
+            digest = hashlib.sha256()
+            with open(job['path'], 'rb') as f:
+                for chunk in iter(lambda: f.read(DownloadManager.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            job['file_hash'] = digest.hexdigest()
+            # Одинаковое содержимое загружается в хранилище один раз
+            self.job_queue.put_blob(job['file_hash'], job['path'])
+            shared['file_hash'] = job['file_hash']
+            shared['ext'] = os.path.splitext(job['path'])[1]
+        else:
+            shared['path'] = os.path.abspath(job['path'])
+        return shared
 
-    def split_text(self, text, max_length):
-        """Разделяет текст на части, не превышающие max_length символов."""
-        words = text.split()
-        messages = []
-        current_message = ""
+    def collect_results(self):
+        """Раздельный режим, ingest: доставляет пользователям результаты воркеров."""
+        while True:
+            try:
+                results = self.job_queue.take_results(timeout=1)
+            except Exception as e:
+                logging.error(f'Failed to read results from the shared queue: {e}')
+                time.sleep(5)
+                continue
+            for result in results:
+                job = self.chat_manager.get_job(result['job_id'])
+                if job is None:
+                    logging.warning(f'Result for unknown job {result["job_id"]} ignored')
+                    continue
+                try:
+                    with JobProfiler.activate(job['id']):
+                        self.apply_result(job, result)
+                except Exception as e:
+                    logging.error(f'Error delivering result of job {job["id"]}: {e}')
+                    self.release_job(job)
+
+    def apply_result(self, job, result):
+        chat_id = job['chat_id']
+        message_id = job['message_id']
+        if result['type'] == 'started':
+            self.api.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                       text="Распознавание...", parse_mode='HTML')
+        elif result['type'] == 'partial':
+            self.show_partial_transcription(chat_id, message_id, [result['text']])
+        elif result['type'] == 'error':
+            logging.error(f'Worker failed job {job["id"]}: {result.get("error")}')
+            self.fail_job(job)
+        else:
+            if not result.get('duplicate'):
+                self.load_controller.observe(result['audio_seconds'], result['transcribe_seconds'])
+                self.eta.observe(job, self.model_name(job.get('level') or 0), result['audio_seconds'],
+                                 result['transcribe_seconds'])
+                self.observe_language(job, result.get('language'), result.get('language_probability'))
+            self.chat_manager.set_state(job, 'sending')
+            try:
+                if job.get('export'):
+                    export = TranscriptExport(job['export'])
+                    for segment in result['segments']:
+                        export.add(*segment)
+                    self.send_export(job, export, time.time() - job['queued_at'])
+                    return
+                if job.get('cache_key') and job.get('level') == 0:
+                    self.cache.put(job['cache_key'], result['text'])
+                self.deliver_transcription(job, result['text'], time.time() - job['queued_at'],
+                                           result.get('segments'))
+            finally:
+                self.release_job(job)
 
-        for word in words:
-            if len(current_message) + len(word) + 1 <= max_length:
-                current_message += (" " if current_message else "") + word
+    def remote_worker(self, model):
+        """Раздельный режим, воркер: берёт задачи из общей очереди и публикует результаты для ingest."""
+        while True:
+            try:
+                job = self.job_queue.claim(timeout=5)
+            except Exception as e:
+                logging.error(f'Failed to claim a job from the shared queue: {e}')
+                time.sleep(5)
+                continue
+            if job is None:
+                continue
+            with JobProfiler.activate(job['job_id']), self.profiler.sample(job['job_id']):
+                self.process_shared_job(job, model)
+            self.profiler.finish(job['job_id'])
+
+    def process_shared_job(self, job, model):
+        self.job_queue.publish({'job_id': job['job_id'], 'type': 'started'})
+
+        def on_progress(texts):
+            # Заодно продлеваем аренду, чтобы долгую задачу не выдали другому воркеру
+            self.job_queue.renew(job)
+            if self.stream_mode:
+                self.job_queue.publish({'job_id': job['job_id'], 'type': 'partial',
+                                        'text': " ".join(texts)[-MAX_MESSAGE_LENGTH:]})
+
+        fetched = False
+        try:
+            if job.get('file_hash'):
+                job['path'] = os.path.join(self.media_folder, job['file_hash'] + job.get('ext', ''))
+                fetched = self.fetch_shared_file(job)
+            audio = self.decode(job)
+            duplicate, fingerprint = self.find_duplicate(job, audio)
+            if duplicate is not None:
+                result = {'type': 'done', 'text': duplicate, 'duplicate': True}
             else:
-                messages.append(current_message)
-                current_message = word
+                segments, transcribe_seconds, info = self.run_transcription(job, model, audio,
+                                                                            job.get('level') or 0, on_progress)
+                result = {'type': 'done', 'text': join_segments(segments), 'segments': segments,
+                          'audio_seconds': len(audio) / SAMPLE_RATE,
+                          'transcribe_seconds': transcribe_seconds, 'language': info.language,
+                          'language_probability': info.language_probability}
+                if not job.get('level'):
+                    self.remember_transcription(fingerprint, audio, result['text'])
+        except Exception as e:
+            logging.error(f'Error during transcription of shared job {job["job_id"]}: {e}')
+            result = {'type': 'error', 'error': str(e)}
+        finally:
+            audio = None
+            self.memory.release(job.pop('pcm_bytes', 0))
+            if fetched:
+                try:
+                    os.remove(job['path'])
+                except OSError as e:
+                    logging.error(f'Failed to remove {job["path"]}: {e}')
+        self.job_queue.complete(job, dict(result, job_id=job['job_id']))
+
+    def fetch_shared_file(self, job):
+        """Скачивает файл задачи из общей очереди по хешу; возвращает True, если файл создан заново."""
+        if os.path.exists(job['path']):
+            return False
+        data = self.job_queue.fetch_blob(job['file_hash'])
+        if data is None:
+            raise FileNotFoundError(f'blob {job["file_hash"]} is missing from the shared queue')
+        with open(job['path'] + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(job['path'] + '.part', job['path'])
+        return True
+
+    def process_batch(self, jobs, model):
+        """Распознаёт пакет коротких задач одним проходом модели и отвечает каждой в свой чат."""
+        start_time = time.time()
+        ready = []
+        fingerprints = {}
+        for job in jobs:
+            set_current_job(job['id'])
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text="Распознавание...", parse_mode='HTML')
+            try:
+                audio = self.decode(job)
+            except Exception as e:
+                logging.error(f'Error decoding batched job {job["id"]}: {e}')
+                self.fail_job(job)
+                continue
+            if len(audio) > self.batcher.max_duration * SAMPLE_RATE:
+                # Telegram округляет длительность: запись, не влезающая в окно модели, идёт отдельно
+                self.process_decoded_job(job, model, audio, start_time)
+                continue
+            duplicate, fingerprints[job['id']] = self.find_duplicate(job, audio)
+            if duplicate is not None:
+                try:
+                    self.chat_manager.set_state(job, 'sending')
+                    self.deliver_transcription(job, duplicate, time.time() - start_time)
+                except Exception as e:
+                    logging.error(f'Error delivering duplicate transcription: {e}')
+                finally:
+                    self.release_job(job)
+                continue
+            ready.append((job, audio))
+
+        set_current_job(jobs[0]['id'])
+        if not ready:
+            return
+        level = self.load_controller.update()
+        transcribe_start = time.time()
+        try:
+            transcriptions = self.batcher.transcribe(self.model_for_level(model, level),
+                                                     [audio for _, audio in ready],
+                                                     **self.transcribe_options(level, jobs[0]['language']))
+        except Exception as e:
+            logging.error(f'Error during batched transcription: {e}')
+            for job, _ in ready:
+                self.fail_job(job)
+            return
+
+        duration = time.time() - start_time
+        transcribe_seconds = time.time() - transcribe_start
+        batch_audio_seconds = sum(len(audio) for _, audio in ready) / SAMPLE_RATE
+        self.load_controller.observe(batch_audio_seconds, transcribe_seconds)
+        # Время общего прохода относим к каждой задаче пакета, RTF — к суммарной длительности пакета
+        for job, audio in ready:
+            self.metrics.observe_transcription(job, transcribe_seconds, batch_audio_seconds)
+            # Для ETA время прохода делится между задачами пакета пропорционально длительности
+            self.eta.observe(job, self.model_name(level), len(audio) / SAMPLE_RATE,
+                             transcribe_seconds * len(audio) / SAMPLE_RATE / batch_audio_seconds)
+            self.profiler.add_span(job['id'], 'batch_transcription', transcribe_start,
+                                   transcribe_start + transcribe_seconds, batch_size=len(ready))
+        for (job, audio), transcription in zip(ready, transcriptions):
+            set_current_job(job['id'])
+            try:
+                self.chat_manager.set_state(job, 'sending')
+                if level == 0:
+                    if job.get('cache_key'):
+                        self.cache.put(job['cache_key'], transcription)
+                    self.remember_transcription(fingerprints[job['id']], audio, transcription)
+                self.deliver_transcription(job, transcription, duration)
+            except Exception as e:
+                logging.error(f'Error delivering batched transcription: {e}')
+                self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                           text="Ошибка во время распознавания", parse_mode='HTML')
+            finally:
+                self.release_job(job)
 
-        if current_message:
-            messages.append(current_message)
+    def fail_job(self, job):
+        self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                   text="Ошибка во время распознавания", parse_mode='HTML')
+        self.release_job(job)
 
-        return messages
+    def release_job(self, job):
+        try:
+            os.remove(job['path'])
+        except OSError as e:
+            logging.error(f'Failed to remove {job["path"]}: {e}')
+        # Тот же файл может быть у другой задачи в работе — тогда копия в очереди ещё нужна
+        if job.get('file_hash') and not any(other.get('file_hash') == job['file_hash'] and other is not job
+                                            for other in self.chat_manager.active()):
+            try:
+                self.job_queue.drop_blob(job['file_hash'])
+            except Exception as e:
+                logging.error(f'Failed to drop shared file {job["file_hash"]}: {e}')
+        self.memory.release(job.pop('file_bytes', 0) + job.pop('pcm_bytes', 0))
+        self.chat_manager.finish_chat(job)
+        self.profiler.finish(job['id'])
+
+    def model_name(self, level):
+        """Модель и режим поиска для уровня качества — ключ статистики RTF для ETA."""
+        if level >= 2 and self.fallback_model_size:
+            return f"{self.fallback_model_size}/greedy"
+        return self.model_size if level == 0 else f"{self.model_size}/greedy"
+
+    def model_for_level(self, model, level):
+        if level >= 2 and self.fallback_model is not None:
+            return self.fallback_model
+        return model
+
+    def fixed_language(self):
+        return None if self.language == 'auto' else self.language
+
+    def choose_language(self, job):
+        """Язык записи: заданный LANGUAGE, уверенный профиль чата или None — определить по записи."""
+        return self.fixed_language() or self.languages.choose(job['chat_id'])
+
+    def same_language(self, job, other):
+        """Можно ли распознавать other в одном пакете с job: язык обоих известен заранее и совпадает."""
+        if job.get('language') is None:
+            return False
+        return (self.fixed_language() or self.languages.peek(other['chat_id'])) == job['language']
+
+    def observe_language(self, job, language, probability):
+        if self.fixed_language() is None and job.get('language') is None and language:
+            self.languages.observe(job['chat_id'], language, probability)
+
+    def language_text(self, chat_id):
+        if self.fixed_language():
+            return f"Language: {self.language} (fixed)"
+        profile = self.languages.describe(chat_id)
+        if profile is None:
+            return "Language: auto, not detected in this chat yet"
+        language, confidence, detections = profile
+        state = 'confident' if confidence >= self.languages.threshold else 'detecting'
+        return f"Language: {language} ({state}, confidence {confidence:.2f} after {detections} detection(s))"
+
+    def transcribe_options(self, level=0, language=None, word_timestamps=False):
+        return dict(
+            word_timestamps=word_timestamps,
+            # None — Whisper определяет язык по первым 30 секундам
+            language=language,
+            # Под нагрузкой переходим на жадный поиск
+            beam_size=self.beam_size if level == 0 else 1,
+        )
+
+    def transcribe_audio(self, model, audio, level=0, language=None, word_timestamps=False):
+        """Запускает распознавание; длинные записи режутся VAD по паузам и распознаются пакетами."""
+        # Используем встроенный VAD для лучшей обработки пауз
+        options = dict(self.transcribe_options(level, language, word_timestamps), vad_filter=True)
+        if self.long_media_seconds and len(audio) >= self.long_media_seconds * SAMPLE_RATE:
+            # Пайплайн хранит состояние между вызовами, поэтому создаётся на каждую задачу.
+            # Сегменты возвращаются по порядку с таймкодами исходной записи.
+            pipeline = BatchedInferencePipeline(model=model)
+            return pipeline.transcribe(audio, batch_size=self.long_media_batch_size, **options)
+        return model.transcribe(audio, **options)
+
+    def show_partial_transcription(self, chat_id, message_id, texts):
+        """Правит статусное сообщение хвостом уже распознанного текста."""
+        limit = MAX_MESSAGE_LENGTH - 100
+        tail = []
+        length = 0
+        for text in reversed(texts):
+            tail.append(text)
+            length += len(text) + 1
+            if length >= limit:
+                break
+        partial = " ".join(reversed(tail)).strip()
+        if len(partial) > limit:
+            partial = '…' + partial[-limit:].split(' ', 1)[-1]
+        if not partial:
+            return
+        self.api.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                   text=f"<blockquote expandable>{escape_html(partial)}</blockquote>"
+                                        "\nРаспознавание...",
+                                   parse_mode='HTML')
+
+    def deliver_transcription(self, job, transcription, duration, segments=None):
+        """Отправляет готовую расшифровку: правит статусное сообщение, досылает части или .txt.
+
+        segments — сегменты с таймкодами, если они есть: по ним выбираются границы частей.
+        """
+        chat_id = job['chat_id']
+        message_id = job['message_id']
+
+        if not transcription.strip():
+            # Если расшифровка пустая — обновляем сообщение, чтобы не оставлять 'Распознавание...'
+            no_text = "Ничего не распознано."
+            if self.debug_mode:
+                no_text += f"\nВремя распознавания: {duration:.2f} секунд"
+            self.api.edit_message_text(chat_id=chat_id, message_id=message_id, text=no_text, parse_mode='HTML')
+            return
+
+        footer = f"\nВремя распознавания: {duration:.2f} секунд" if self.debug_mode else ""
+        # Голосовые и видеосообщения можно прислать несколькими сообщениями, остальное — одним или файлом
+        if job['media_type'] in ('voice', 'video_note'):
+            max_messages = self.max_inline_messages
+        else:
+            max_messages = 1
+        messages = self.planner.plan(transcription, segments, max_messages, reserve=utf16_length(footer))
+        if messages is None:
+            self.send_transcription_file(job, transcription, duration)
+            return
+
+        if len(messages) == 1:
+            self.api.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                       text=messages[0] + footer, parse_mode='HTML')
+            return
+
+        # Остальные части отвечают на первую: правка должна дойти до Telegram раньше них
+        self.api.edit_message_text_now(chat_id=chat_id, message_id=message_id,
+                                       text=messages[0] + footer, parse_mode='HTML')
+        previous_message_id = message_id
+        for msg in messages[1:]:
+            sent_message = self.api.send_message(
+                chat_id=chat_id,
+                text=msg,
+                parse_mode='HTML',
+                reply_to_message_id=previous_message_id
+            )
+            previous_message_id = sent_message.message_id
+
+    def send_transcription_file(self, job, transcription, duration):
+        """Присылает расшифровку, не помещающуюся в сообщения, файлом .txt."""
+        try:
+            self.send_file(job, io.BytesIO(transcription.encode('utf-8')), '.txt', duration)
+        except Exception as e:
+            logging.error(f'Failed to send transcription txt: {e}')
+            # Фоллбэк: если не удалось отправить файл — отправим начало расшифровки одним сообщением
+            fallback_text = self.planner.split(transcription, limit=self.planner.limit - 1)[0] + '…'
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text=f"<blockquote expandable>{escape_html(fallback_text)}</blockquote>",
+                                       parse_mode='HTML')
+
+    def send_export(self, job, export, duration):
+        """Присылает расшифровку с таймкодами в выбранном пользователем формате."""
+        if not export.count:
+            self.deliver_transcription(job, "", duration)
+            return
+        try:
+            self.send_file(job, export.finish(), export.extension, duration)
+        except Exception as e:
+            logging.error(f'Failed to send {export.format} export: {e}')
+            self.api.edit_message_text(chat_id=job['chat_id'], message_id=job['message_id'],
+                                       text="Не удалось отправить файл с расшифровкой")
+
+    def send_file(self, job, buffer, extension, duration):
+        """Отправляет файл прямо из буфера в памяти и отмечает это в статусном сообщении."""
+        chat_id = job['chat_id']
+        message_id = job['message_id']
+        if job['path']:
+            base_name = os.path.splitext(os.path.basename(job['path']))[0]
+        else:
+            base_name = f"transcription_{chat_id}_{message_id}"
+        caption = None
+        if self.debug_mode:
+            caption = f"Время распознавания: {duration:.2f} секунд"
+        self.api.send_document(chat_id=chat_id, document=buffer, caption=caption,
+                               visible_file_name=base_name + extension)
+        # Обновляем исходное сообщение
+        self.api.edit_message_text(chat_id=chat_id, message_id=message_id, text="Расшифровка отправлена файлом.")
 
     def queue_manager(self):
-        previous_queue_states = {}
+        """Обновляет у ожидающих задач статус «В очереди» позицией и оценкой времени.
+
+        Правка отправляется, только если округлённый текст изменился и с прошлой правки
+        этого сообщения прошло не меньше queue_update_interval секунд. За один проход
+        ставится не больше QUEUE_UPDATE_API_SHARE общего лимита Bot API — ближайшие к началу
+        задачи первыми, — а пока у диспетчера копятся другие правки, проход пропускается:
+        ответы с расшифровками важнее. Лимит на чат и очерёдность после ответов соблюдает
+        TelegramDispatcher.update_status.
+        """
+        budget = max(1, int(TelegramDispatcher.GLOBAL_RATE * QUEUE_UPDATE_TICK * QUEUE_UPDATE_API_SHARE))
+        sent = {}
         while True:
+            time.sleep(QUEUE_UPDATE_TICK)
             try:
-                current_queue_length = self.chat_manager.count_chats()
-                for index, chat in enumerate(self.chat_manager.chat_data):
-                    chat_id = chat['chat_id']
-                    message_id = chat['message_id']
-                    # Only edit the message if the state has changed
-                    if (chat_id, message_id) not in previous_queue_states or previous_queue_states[
-                        (chat_id, message_id)] != index:
-                        try:
-                            if index > 0:
-                                self.bot.edit_message_text(
-                                    chat_id=chat_id,
-                                    message_id=message_id,
-                                    text="В очереди",
-                                )
-                            previous_queue_states[(chat_id, message_id)] = index
-                        except telebot.apihelper.ApiTelegramException as e:
-                            logging.error(f'Failed to edit message: {e}')
-                time.sleep(1)
+                if self.api.pending_edits() >= budget:
+                    continue
+                now = time.time()
+                queued = self.chat_manager.snapshot()
+                running = [job for job in self.chat_manager.active() if job['state'] == 'transcribing']
+                level = self.load_controller.level
+                estimates = self.eta.estimate(queued, running, self.model_name(level), now)
+                waiting = {job['id'] for job in queued}
+                for job_id in [job_id for job_id in sent if job_id not in waiting]:
+                    del sent[job_id]
+
+                updates = 0
+                for job, position, start, finish in estimates:
+                    if updates >= budget:
+                        break
+                    text = self.queue_status_text(position, start, finish)
+                    previous = sent.get(job['id'])
+                    if previous is not None and (previous[0] == text or now - previous[1] < self.queue_update_interval):
+                        continue
+                    if self.api.update_status(text, job['chat_id'], job['message_id'],
+                                              lambda job=job: job['state'] == 'queued'):
+                        sent[job['id']] = (text, now)
+                        updates += 1
             except Exception as e:
                 logging.error(f'Error in queue manager: {e}')
-                time.sleep(1)
+
+    def queue_status_text(self, position, start, finish):
+        if start < 1:
+            return f"Место в очереди: {position}\nГотово примерно через {format_eta(finish)}"
+        return (f"Место в очереди: {position}\nНачало примерно через {format_eta(start)}, "
+                f"готово примерно через {format_eta(finish)}")
 
     def process_ping_all(self, message):
         chat_id = message.chat.id
-        all_members = []
 
         try:
-            # Получаем информацию о чате
-            chat = self.bot.get_chat(chat_id)
-
-            # Проверяем, является ли бот администратором
-            bot_member = self.bot.get_chat_member(chat_id, self.bot.get_me().id)
-            if bot_member.status not in ['administrator', 'creator']:
-                self.bot.send_message(chat_id, "Бот должен быть администратором, чтобы упоминать участников.")
+            # Статус бота берём из того же списка администраторов: оба вызова кэшируются
+            bot_id = self.chat_cache.get('me', self.api.get_me).id
+            members = self.chat_cache.get(('administrators', chat_id),
+                                          lambda: self.api.get_chat_administrators(chat_id))
+            if not any(member.user.id == bot_id for member in members):
+                self.api.send_message(chat_id, "Бот должен быть администратором, чтобы упоминать участников.")
                 return
 
-            # Получаем всех участников чата (может быть ограничено)
-            members = self.bot.get_chat_administrators(chat_id)
-
             # Формируем упоминания участников
+            all_members = []
             for member in members:
                 user = member.user
                 if user.is_bot:
@@ -611,22 +3680,38 @@ class VoiceBot:
                 if user.username:
                     mention = f'@{user.username}'
                 else:
-                    mention = f'<a href="tg://user?id={user.id}">{user.first_name}</a>'
+                    mention = f'<a href="tg://user?id={user.id}">{escape_html(user.first_name)}</a>'
                 all_members.append(mention)
 
-            # Отправляем сообщение, если есть упоминания
-            ping_message = ' '.join(all_members)
-
-            if ping_message:
-                self.bot.send_message(chat_id, ping_message, parse_mode='HTML')
-            else:
-                self.bot.send_message(chat_id, "Не удалось получить список участников для упоминания.")
+            if not all_members:
+                self.api.send_message(chat_id, "Не удалось получить список участников для упоминания.")
+                return
+            for ping_message in self.split_mentions(all_members):
+                self.api.send_message(chat_id, ping_message, parse_mode='HTML')
         except Exception as e:
             logging.error(f'Error in ping_all: {e}')
-            self.bot.send_message(chat_id, f"Не удалось получить список участников: {e}")
+            self.api.send_message(chat_id, f"Не удалось получить список участников: {e}")
+
+    def split_mentions(self, mentions):
+        """Группирует упоминания в сообщения не длиннее MAX_MESSAGE_LENGTH
+        и не больше MAX_MENTIONS_PER_MESSAGE упоминаний в каждом."""
+        messages = []
+        current = []
+        length = 0
+        for mention in mentions:
+            if current and (len(current) >= MAX_MENTIONS_PER_MESSAGE
+                            or length + 1 + len(mention) > MAX_MESSAGE_LENGTH):
+                messages.append(' '.join(current))
+                current = []
+                length = 0
+            length += len(mention) + (1 if current else 0)
+            current.append(mention)
+        if current:
+            messages.append(' '.join(current))
+        return messages
 
 
 if __name__ == "__main__":
-    setup_logging('bot.log')
+    setup_logging('bot.log', job_ids=os.getenv('PROFILE_MODE', 'False').lower() in ('1', 'true', 'yes'))
     voice_bot = VoiceBot()
     voice_bot.start()